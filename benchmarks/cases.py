@@ -0,0 +1,172 @@
+"""
+Benchmark cases, each measuring one or more metrics with a Bench, see run.py.
+"""
+import grp
+import os
+import tempfile
+from collections import OrderedDict
+
+import jinja2
+from fabric.context_managers import settings
+from fabric.state import env
+
+from refabric.api import run
+from refabric.context_managers import batch, sudo
+from refabric.contrib import templates
+from refabric.state import apply_role_definitions
+from refabric.utils import resolve
+from refabric.utils.resolver import invalidate
+
+__all__ = ['cases']
+
+cases = OrderedDict()
+
+
+def case(func):
+    cases[func.__name__] = func
+    return func
+
+
+def make_roledefs(roles, keys):
+    """
+    Build dict style roledefs with nested blueprint settings, referencing
+    each other through variables.
+    """
+    roledefs = {}
+    for r in range(roles):
+        blueprints = {}
+        for k in range(keys):
+            blueprints['blueprint{}'.format(k)] = {
+                'version': '{}.{}'.format(r, k),
+                'path': '/srv/$(settings.blueprint{}.version)/app'.format(k),
+                'options': {'workers': k, 'name': 'role{}-$(host_string)'.format(r)},
+            }
+        roledefs['role{}'.format(r)] = {
+            'hosts': ['host{}-{}'.format(r, h) for h in range(4)],
+            'settings': blueprints,
+        }
+    return roledefs
+
+
+@case
+def upload(bench):
+    """
+    Render and upload N templates, first to an empty destination, then unchanged.
+    Rsync transfer is measured when rsync >= 3.1 is installed locally.
+    """
+    source = tempfile.mkdtemp(prefix='refabric-bench-templates-', dir=bench.server.root)
+    os.makedirs(os.path.join(source, 'conf', 'sub'))
+    for i in range(bench.templates):
+        folder = 'sub' if i % 2 else ''
+        with open(os.path.join(source, 'conf', folder, 'site{}.conf'.format(i)), 'w') as f:
+            f.write('server { name {{ name }}-%d; port {{ port + %d }}; }\n' % (i, i) * 20)
+
+    jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader([source]))
+    context = {'name': 'bench', 'port': 8000}
+    user = env.user
+    group = grp.getgrgid(os.getgid()).gr_name
+    destinations = iter(range(1000000))
+
+    def upload_to(destination, transfer):
+        templates.upload('conf/', destination, context=context, user=user, group=group,
+                         jinja_env=jinja_env, transfer=transfer)
+
+    def first_upload(transfer):
+        destination = os.path.join(bench.server.root, 'dest{}'.format(next(destinations)), '')
+        return lambda: upload_to(destination, transfer)
+
+    transfers = ['archive', 'put']
+    if templates.get_rsync_version() >= (3, 1):
+        transfers.append('rsync')
+    else:
+        print('  (rsync >= 3.1 not installed, skipping rsync transfer)')
+
+    with settings(key_filename=bench.server.client_key):
+        for transfer in transfers:
+            bench.measure('first upload ({})'.format(transfer), bench.templates,
+                          setup=lambda: first_upload(transfer))
+
+    destination = os.path.join(bench.server.root, 'unchanged', '')
+    upload_to(destination, 'archive')
+    bench.measure('unchanged upload', bench.templates, lambda: upload_to(destination, 'archive'))
+
+    with settings(verify_remote=True):
+        bench.measure('unchanged upload (verify remote)', bench.templates,
+                      lambda: upload_to(destination, 'archive'))
+
+    if 'rsync' in transfers:
+        with settings(verify_remote=True, key_filename=bench.server.client_key):
+            bench.measure('unchanged upload (rsync)', bench.templates,
+                          lambda: upload_to(destination, 'rsync'))
+
+
+@case
+def resolve_settings(bench):
+    """
+    Resolve nested settings with variables over large roledefs, memoized and not.
+    """
+    keys = 200
+    paths = ['settings.blueprint{}.{}'.format(k, key)
+             for k in range(keys) for key in ('version', 'path', 'options.name')]
+
+    with settings(roledefs=make_roledefs(10, keys)):
+        apply_role_definitions('role0')
+        try:
+            def resolve_all():
+                for path in paths:
+                    resolve(env, path)
+
+            def cold():
+                invalidate(env)
+                return resolve_all
+
+            bench.measure('resolve (cold)', len(paths), setup=cold)
+            bench.measure('resolve (memoized)', len(paths), resolve_all)
+        finally:
+            apply_role_definitions(None)
+
+
+@case
+def role_switch(bench):
+    """
+    Switch between roles with large definitions.
+    """
+    roles = 10
+    with settings(roledefs=make_roledefs(roles, 200)):
+        def switch():
+            for r in range(roles):
+                env.roles = ['role{}'.format(r)]
+
+        try:
+            bench.measure('role switch', roles, switch)
+        finally:
+            apply_role_definitions(None)
+
+
+@case
+def commands(bench):
+    """
+    Per command overhead of run and sudo, one by one and batched.
+    """
+    count = bench.commands
+
+    def run_all():
+        for _ in range(count):
+            run('true')
+
+    def run_batched():
+        with batch():
+            run_all()
+
+    def sudo_all():
+        with sudo():
+            run_all()
+
+    def sudo_batched():
+        with sudo(), batch():
+            run_all()
+
+    bench.measure('run', count, run_all)
+    bench.measure('sudo', count, sudo_all)
+    bench.measure('run (batched)', count, run_batched)
+    bench.measure('sudo (batched)', count, sudo_batched)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+Run refabric benchmarks against an in-process SSH stand-in, see server.py,
+and store results per version in benchmarks/results/<label>.json.
+
+Usage:
+    $ python benchmarks/run.py                       # All cases
+    $ python benchmarks/run.py upload commands       # Selected cases
+    $ python benchmarks/run.py --compare 1.0.0       # Run and compare with stored results
+    $ python benchmarks/run.py --compare 1.0.0 1.0.1 # Compare stored results only
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(ROOT, 'benchmarks', 'results')
+
+# Benchmark the working tree, not an installed refabric
+sys.path.insert(0, ROOT)
+
+
+class Bench(object):
+    """
+    Measures metrics of benchmark cases, with best and median time of a number of repeats.
+    """
+
+    def __init__(self, server, repeat=5, templates=100, commands=50):
+        self.server = server
+        self.repeat = repeat
+        self.templates = templates
+        self.commands = commands
+        self.results = {}
+
+    def measure(self, name, ops, func=None, setup=None):
+        """
+        Time func, or func returned by setup where setup is not timed.
+
+        :param name: Metric name
+        :param ops: Number of operations per call, i.e. templates or commands
+        """
+        timings = []
+        for _ in range(self.repeat):
+            if setup:
+                func = setup()
+            start = time.time()
+            func()
+            timings.append(time.time() - start)
+
+        timings.sort()
+        self.results[name] = {
+            'ops': ops,
+            'best': timings[0],
+            'median': timings[len(timings) // 2],
+        }
+        print('  {:<36} {:>10.3f} ms/op {:>10.3f} ms/op median'.format(
+            name, timings[0] * 1000 / ops, timings[len(timings) // 2] * 1000 / ops))
+
+
+def get_label():
+    """
+    Get refabric version, suffixed with git commit if run from a checkout.
+    """
+    import refabric
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                         stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return refabric.__version__
+    return '{}-{}'.format(refabric.__version__, commit)
+
+
+def get_results_path(label):
+    """
+    Get path of stored results by label, or path if given a .json file.
+    """
+    if label.endswith('.json'):
+        return label
+    return os.path.join(RESULTS, '{}.json'.format(label))
+
+
+def load_results(label):
+    with open(get_results_path(label)) as f:
+        return json.load(f)
+
+
+def save_results(label, results):
+    path = get_results_path(label)
+    if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+        os.makedirs(os.path.dirname(os.path.abspath(path)))
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Results stored in {}'.format(path))
+
+
+def compare(base, other):
+    """
+    Print best ms/op of metrics in both results, with change relative to base.
+    """
+    labels = [os.path.basename(r['label'])[:12] for r in (base, other)]
+    print('{:<50} {:>12} {:>12} {:>8}'.format('', labels[0], labels[1], 'change'))
+    for case in sorted(set(base['cases']) & set(other['cases'])):
+        for name in sorted(set(base['cases'][case]) & set(other['cases'][case])):
+            before, after = [r['cases'][case][name] for r in (base, other)]
+            before = before['best'] * 1000 / before['ops']
+            after = after['best'] * 1000 / after['ops']
+            print('{:<50} {:>12.3f} {:>12.3f} {:>+7.1f}%'.format(
+                '{}: {}'.format(case, name), before, after, (after - before) * 100 / before if before else 0))
+
+
+def run(names, repeat, templates, commands):
+    """
+    Run benchmark cases against an SSH stand-in.
+
+    :return: Results dict
+    """
+    import fabric.state
+    from fabric.context_managers import hide, settings
+    from fabric.network import disconnect_all
+
+    from refabric.bootstrap import bootstrap
+    from server import SSHStandIn
+    from cases import cases
+
+    unknown = set(names) - set(cases)
+    if unknown:
+        sys.exit('Unknown benchmark(s): {}'.format(', '.join(sorted(unknown))))
+
+    bootstrap()
+
+    results = {}
+    with SSHStandIn() as server:
+        bench = Bench(server, repeat=repeat, templates=templates, commands=commands)
+        with settings(hide('everything'),
+                      host_string=server.host_string,
+                      password='benchmark',
+                      no_keys=True,
+                      no_agent=True,
+                      disable_known_hosts=True,
+                      forward_agent=False,
+                      abort_on_prompts=True,
+                      sudo_user=fabric.state.env.user,
+                      cache_root=os.path.join(server.root, 'cache')):
+            for name in names or cases:
+                print('{}:'.format(name))
+                bench.results = {}
+                cases[name](bench)
+                results[name] = bench.results
+            disconnect_all()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run refabric benchmarks against a local SSH stand-in.')
+    parser.add_argument('cases', nargs='*', help='Benchmark cases to run (Default: all)')
+    parser.add_argument('--label', help='Label to store results as (Default: version and git commit)')
+    parser.add_argument('--repeat', type=int, default=5, help='Repeats per metric (Default: 5)')
+    parser.add_argument('--templates', type=int, default=100, help='Templates to upload (Default: 100)')
+    parser.add_argument('--commands', type=int, default=50, help='Commands to run (Default: 50)')
+    parser.add_argument('--compare', nargs='+', metavar='LABEL',
+                        help='Compare run with stored results, or two stored results')
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) > 1:
+        compare(load_results(args.compare[0]), load_results(args.compare[1]))
+        return
+
+    label = args.label or get_label()
+    results = {
+        'label': label,
+        'python': sys.version.split()[0],
+        'cases': run(args.cases, args.repeat, args.templates, args.commands),
+    }
+    save_results(label, results)
+
+    if args.compare:
+        compare(load_results(args.compare[0]), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""
+In-process SSH/SFTP stand-in, running commands and file transfers on the
+local machine as the current user, so benchmarks measure refabric and the
+SSH round trips without network or remote host noise.
+"""
+import getpass
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+
+import paramiko
+
+__all__ = ['SSHStandIn']
+
+# Connections dropped on stop are expected
+logging.getLogger('paramiko').addHandler(logging.NullHandler())
+
+# Stand-in sudo, dropping sudo options and running command as current user
+SUDO = """#!/bin/sh
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -p|-u|-g) shift 2 ;;
+        -*) shift ;;
+        *=*) export "$1"; shift ;;
+        *) break ;;
+    esac
+done
+exec "$@"
+"""
+
+
+class SSHStandIn(object):
+    """
+    SSH server listening on localhost, accepting any credentials.
+
+    Example:
+    >>> with SSHStandIn() as server:
+    ...     with settings(host_string=server.host_string, password='x'):
+    ...         run('true')
+    """
+
+    def __init__(self):
+        self.root = tempfile.mkdtemp(prefix='refabric-bench-')
+        self.home = os.path.join(self.root, 'home')
+        self.bin = os.path.join(self.root, 'bin')
+        os.makedirs(self.home)
+        os.makedirs(self.bin)
+        os.makedirs(os.path.join(self.root, 'agent'))
+
+        sudo = os.path.join(self.bin, 'sudo')
+        with open(sudo, 'w') as f:
+            f.write(SUDO)
+        os.chmod(sudo, 0o755)
+
+        self.env = dict(os.environ,
+                        HOME=self.home,
+                        PATH=os.pathsep.join((self.bin, os.environ.get('PATH', ''))),
+                        SSH_AUTH_SOCK=os.path.join(self.root, 'agent', 'socket'))
+
+        self.host_key = paramiko.RSAKey.generate(2048)
+
+        # Key for ssh clients other than fabric's, i.e. rsync
+        self.client_key = os.path.join(self.root, 'client_key')
+        paramiko.RSAKey.generate(2048).write_private_key_file(self.client_key)
+        self.socket = None
+        self.transports = []
+
+    @property
+    def host_string(self):
+        return '{}@127.0.0.1:{}'.format(getpass.getuser(), self.port)
+
+    def start(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(16)
+        self.port = self.socket.getsockname()[1]
+
+        thread = threading.Thread(target=self.serve, name='ssh-stand-in')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        for transport in self.transports:
+            transport.close()
+        self.socket.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def serve(self):
+        while True:
+            try:
+                client, _ = self.socket.accept()
+            except socket.error:
+                return  # Stopped
+
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSFTP, home=self.home)
+            transport.start_server(server=Server(self))
+            self.transports.append(transport)
+
+    def execute(self, channel, command):
+        """
+        Run command in a local shell, sending combined output and exit status over channel.
+        """
+        with open(os.devnull) as devnull:
+            process = subprocess.Popen(['/bin/bash', '-c', command], stdin=devnull,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                       cwd=self.home, env=self.env)
+        while True:
+            chunk = os.read(process.stdout.fileno(), 65536)
+            if not chunk:
+                break
+            channel.sendall(chunk)
+
+        channel.send_exit_status(process.wait())
+        channel.close()
+
+
+class Server(paramiko.ServerInterface):
+
+    def __init__(self, stand_in):
+        self.stand_in = stand_in
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.stand_in.execute, args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class LocalSFTP(paramiko.SFTPServerInterface):
+    """
+    SFTP on the local file system, relative paths starting in the stand-in home.
+    """
+
+    def __init__(self, server, home=None, *args, **kwargs):
+        super(LocalSFTP, self).__init__(server, *args, **kwargs)
+        self.home = home
+
+    def path(self, path):
+        return os.path.join(self.home, path)
+
+    def canonicalize(self, path):
+        return os.path.normpath(self.path(path))
+
+    def list_folder(self, path):
+        path = self.path(path)
+        try:
+            return [paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)), name)
+                    for name in os.listdir(path)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self.path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        path = self.path(path)
+        try:
+            fd = os.open(path, flags | getattr(os, 'O_BINARY', 0), getattr(attr, 'st_mode', None) or 0o666)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+
+        handle = paramiko.SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        return self.call(os.remove, self.path(path))
+
+    def rename(self, oldpath, newpath):
+        return self.call(os.rename, self.path(oldpath), self.path(newpath))
+
+    def mkdir(self, path, attr):
+        return self.call(os.mkdir, self.path(path))
+
+    def rmdir(self, path):
+        return self.call(os.rmdir, self.path(path))
+
+    def chattr(self, path, attr):
+        return self.call(paramiko.SFTPServer.set_file_attr, self.path(path), attr)
+
+    def symlink(self, target_path, path):
+        return self.call(os.symlink, target_path, self.path(path))
+
+    def readlink(self, path):
+        try:
+            return os.readlink(self.path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def call(self, func, *args):
+        try:
+            func(*args)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
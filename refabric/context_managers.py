@@ -18,6 +18,27 @@ def role(name):
         apply_role_definitions(None)
 
 
+@contextmanager
+def batch():
+    """
+    Queue run/sudo calls and ship them as one remote script on exit.
+    Queued calls return BatchResult objects, which are populated with return
+    code and output on flush.
+
+    Example:
+    >>> with batch() as commands:
+    ...     run('mkdir -p /srv/app')
+    ...     result = run('ln -sf /srv/app /app')
+    ...     commands.flush()  # Optional, to inspect results within block
+    ...     result.return_code
+    """
+    from .operations import Batch
+    commands = Batch()
+    with settings(batch=commands):
+        yield commands
+    commands.flush()
+
+
 silent = lambda *h: settings(hide('commands', *h), warn_only=True)
 hide_prefix = lambda: settings(output_prefix=False)
 abort_on_error = lambda: settings(warn_only=False)
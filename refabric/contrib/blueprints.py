@@ -1,20 +1,25 @@
+import bisect
 import shutil
 import jinja2
 import importlib
 import os
-from functools import partial
 
-from fabric.api import local
-from fabric.contrib import files
+from fabric.api import local, settings
 from fabric.state import env
 from fabric.utils import warn
 
-from .templates import upload
+from .templates import download, download_hosts, get_jinja_helpers, upload, \
+    upload_hosts
 from ..context_managers import sudo, silent, hide_prefix
-from ..utils import info, resolve
+from ..selection import HostIndex
+from ..state import apply_role_definitions
+from ..utils import SettingsView, get_cache_dir, info
 
 __all__ = ['get']
 
+# Jinja environments per blueprint, role and extra template dirs
+jinja_envs = {}
+
 
 def get(blueprint):
     return Blueprint(blueprint)
@@ -25,8 +30,7 @@ class Blueprint(object):
     def __init__(self, blueprint):
         self.blueprint = blueprint
         self.name = blueprint.rsplit('.')[-1]
-        self.settings = partial(resolve, env,
-                                prefix='settings.{}'.format(self.name))
+        self.settings = SettingsView(env, 'settings.{}'.format(self.name))
 
     def __contains__(self, item):
         return bool(self.settings(item))
@@ -34,14 +38,21 @@ class Blueprint(object):
     def get(self, setting, default=None):
         return self.settings(setting, default=default)
 
-    def fetch(self, *settings):
-        return {setting: self.get('setting') for setting in settings}
+    def fetch(self, *settings, **kwargs):
+        return self.settings.fetch(*settings, **kwargs)
+
+    def get_role(self):
+        """
+        Get current role, being the first of env.roles, since that is the
+        role applied into env, see refabric.state.apply_role_definitions().
+        """
+        return env.roles[0] if env.roles else None
 
     def get_user_template_path(self, relative_path='', role=None):
         deploy_root = env['real_fabfile']
         path = [os.path.dirname(deploy_root), 'templates']
         if not role:
-            role = env.roles[0] if env.roles else None  # TODO: Is this safe?
+            role = self.get_role()
             if role:
                 path.append(role)
         path.append(self.name)
@@ -54,11 +65,27 @@ class Blueprint(object):
         return os.path.join(blueprint_library_path, 'templates', self.name, '')
 
     def get_template_loader(self):
-        role = env.roles[0] if env.roles else None  # TODO: Is this safe?
-        return BlueprintTemplateLoader(self, role=role)
+        return BlueprintTemplateLoader(self, role=self.get_role())
 
     def get_jinja_env(self):
-        return jinja2.Environment(loader=self.get_template_loader())
+        """
+        Get Jinja environment for current role, reused within the same run and
+        with compiled templates cached on disk between runs.
+        Templates are recompiled when changed, by mtime and checksum.
+        """
+        key = (self.blueprint, self.get_role(),
+               tuple(env.get('template_dirs', '')))
+        jinja_env = jinja_envs.get(key)
+        if jinja_env is None:
+            bytecode_cache = jinja2.FileSystemBytecodeCache(
+                get_cache_dir('jinja'))
+            jinja_env = jinja2.Environment(loader=self.get_template_loader(),
+                                           bytecode_cache=bytecode_cache,
+                                           auto_reload=True)
+            jinja_env.globals.update(get_jinja_helpers())
+            # Keep the first one created, if created by concurrent threads
+            jinja_env = jinja_envs.setdefault(key, jinja_env)
+        return jinja_env
 
     def render_template(self, template, context=None):
         text = self.get_jinja_env()\
@@ -67,35 +94,92 @@ class Blueprint(object):
         text = text.encode('utf-8')
         return text
 
-    def upload(self, template, destination, context=None, user=None,
-               group=None):
-        jinja_env = self.get_jinja_env()
+    def get_context(self, context=None):
         context = context or {}
         context.setdefault('host', env.host_string)
         context['hosts'] = env.hosts
         context['env'] = env.shell_env
         context['state'] = env.state
         context['settings'] = self.get(None)
+        return context
+
+    def upload(self, template, destination, context=None, user=None,
+               group=None, verify_remote=None):
+        jinja_env = self.get_jinja_env()
+        context = self.get_context(context)
         with sudo('root'):
             return upload(template, destination, context=context, user=user,
                           group=group,
-                          jinja_env=jinja_env)
+                          jinja_env=jinja_env,
+                          verify_remote=verify_remote)
 
-    def download(self, remote_path, rel_destination_path, role=None):
+    def upload_hosts(self, template, destination, context=None, user=None,
+                     group=None, verify_remote=None, hosts=None,
+                     pool_size=None):
         """
-        Currently only supports downloading single file
+        Upload templates to several hosts in parallel, rendered once per
+        distinct context, see templates.upload_hosts().
+
+        :param hosts: Hosts to upload to (Default: env.all_hosts)
+        :param pool_size: Max number of hosts to push to concurrently
+        :return: Dict of host string to list of updated files, or error if failed
+        """
+        jinja_env = self.get_jinja_env()
+        hosts = hosts or env.all_hosts or [env.host_string]
+
+        # Build contexts with each host's role applied, preferring current roles
+        index = HostIndex(hosts, env.roledefs)
+        roles = list(env.roles) + sorted(set(env.roledefs) - set(env.roles))
+        contexts = {}
+        try:
+            for host in hosts:
+                host_role = next((r for r in roles if host in index.match_role(r)), None)
+                apply_role_definitions(host_role)
+                with settings(host_string=host, host=host):
+                    contexts[host] = self.get_context(dict(context or {}))
+        finally:
+            apply_role_definitions(self.get_role())
+
+        with sudo('root'):
+            return upload_hosts(template, destination, contexts, user=user,
+                                group=group,
+                                jinja_env=jinja_env,
+                                verify_remote=verify_remote,
+                                pool_size=pool_size)
+
+    def download(self, remote_path, rel_destination_path, role=None,
+                 workers=None):
+        """
+        Download a remote file or folder into user templates, skipping files
+        with a matching local copy, see templates.download().
+
+        :param remote_path: Remote file or folder path
+        :param rel_destination_path: Destination relative to user templates
+        :param role: Role templates to download into (Default: current role)
+        :param workers: Number of files to fetch concurrently
+        :return: List of downloaded local files
         """
         destination_path = self.get_user_template_path(rel_destination_path,
                                                        role=role)
+        with sudo('root'):
+            return download(remote_path, destination_path, workers=workers)
 
-        # Append filename to destination if missing
-        filename = os.path.basename(remote_path)
-        if os.path.basename(destination_path) != filename:
-            destination_path = os.path.join(destination_path, filename)
+    def download_hosts(self, remote_path, rel_destination_path, role=None,
+                       hosts=None, workers=None, pool_size=None):
+        """
+        Download a remote file or folder from several hosts in parallel, into
+        a folder per host within user templates, see templates.download_hosts().
 
+        :param hosts: Hosts to download from (Default: env.all_hosts)
+        :param pool_size: Max number of hosts to download from concurrently
+        :return: Dict of host string to list of downloaded files
+        """
+        destination_path = self.get_user_template_path(rel_destination_path,
+                                                       role=role)
+        hosts = hosts or env.all_hosts or [env.host_string]
         with sudo('root'):
-            info('Downloading {} -> {}', remote_path, destination_path)
-            files.get(remote_path, destination_path)
+            return download_hosts(remote_path, destination_path, hosts,
+                                  workers=workers, pool_size=pool_size)
 
     def inherit_templates(self, role=None):
         """
@@ -154,3 +238,74 @@ class BlueprintTemplateLoader(jinja2.FileSystemLoader):
         templates.extend(env_templates)
 
         super(BlueprintTemplateLoader, self).__init__(templates)
+
+        # Sorted template names, their source paths, and mtimes of indexed directories
+        self.index = []
+        self.index_sources = {}
+        self.index_mtimes = {}
+
+    def list_templates(self):
+        self.refresh_index()
+        return list(self.index)
+
+    def find_templates(self, prefix=''):
+        """
+        List templates starting with given prefix, i.e. 'nginx/'.
+
+        :param prefix: Template name prefix
+        :return: Sorted list of template names
+        """
+        self.refresh_index()
+        start = bisect.bisect_left(self.index, prefix)
+        end = start
+        while end < len(self.index) and self.index[end].startswith(prefix):
+            end += 1
+        return self.index[start:end]
+
+    def get_source_path(self, template):
+        """
+        Get path of template in first search path having it.
+
+        :param template: Template name
+        :return: Absolute file path or None if not found
+        """
+        self.refresh_index()
+        return self.index_sources.get(template)
+
+    def refresh_index(self):
+        """
+        Rebuild index of templates across search paths, if any search path or
+        sub directory has changed since last build.
+        """
+        if self.index_mtimes and all(get_mtime(directory) == mtime
+                                     for directory, mtime
+                                     in self.index_mtimes.iteritems()):
+            return
+
+        sources = {}
+        mtimes = {}
+        for searchpath in self.searchpath:
+            mtimes[searchpath] = get_mtime(searchpath)
+            walk = os.walk(searchpath,
+                           followlinks=getattr(self, 'followlinks', False))
+            for directory, _, filenames in walk:
+                mtimes[directory] = get_mtime(directory)
+                for filename in filenames:
+                    template = os.path.join(directory, filename)
+                    template = template[len(searchpath):]\
+                        .strip(os.path.sep)\
+                        .replace(os.path.sep, '/')
+                    if template[:2] == './':
+                        template = template[2:]
+                    sources.setdefault(template, os.path.abspath(os.path.join(directory, filename)))
+
+        self.index = sorted(sources)
+        self.index_sources = sources
+        self.index_mtimes = mtimes
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
@@ -0,0 +1,11 @@
+from .. import facts
+
+
+def exists(path, use_sudo=False, verbose=False):
+    """
+    Patched version of fabric.contrib.files.exists.
+    Memoized per host until a remote write, see refabric.facts.
+    """
+    if verbose:
+        return exists.original(path, use_sudo=use_sudo, verbose=verbose)
+    return facts.exists(path, use_sudo=use_sudo)
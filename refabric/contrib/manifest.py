@@ -0,0 +1,59 @@
+import hashlib
+import json
+import os
+import re
+
+from fabric.state import env
+
+from ..utils import get_cache_dir
+
+__all__ = ['Manifest', 'checksum']
+
+
+def checksum(path, chunk_size=65536):
+    """
+    Get md5 hex digest of a local file, same as remote `md5sum` would give.
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class Manifest(dict):
+    """
+    Local record of the rendered output last uploaded to a host, mapping
+    remote file paths to checksum and owner.
+    """
+
+    def __init__(self, host, *args, **kwargs):
+        super(Manifest, self).__init__(*args, **kwargs)
+        self.host = host
+        filename = '{}.json'.format(re.sub(r'[^\w.@-]', '_', host))
+        self.path = os.path.join(get_cache_dir('manifests'), filename)
+
+    @classmethod
+    def load(cls, host=None):
+        """
+        Load manifest for given host, defaults to current host.
+        """
+        manifest = cls(host or env.host_string)
+        if os.path.exists(manifest.path):
+            with open(manifest.path) as f:
+                manifest.update(json.load(f))
+        return manifest
+
+    def is_uploaded(self, path, md5, owner):
+        entry = self.get(path) or {}
+        return entry.get('md5') == md5 and entry.get('owner') == owner
+
+    def set_uploaded(self, path, md5, owner):
+        self[path] = {'md5': md5, 'owner': owner}
+
+    def save(self):
+        # Write to temp file first, to never leave a truncated manifest behind
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
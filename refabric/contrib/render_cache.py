@@ -0,0 +1,184 @@
+import fcntl
+import hashlib
+import json
+import os
+import time
+import threading
+import uuid
+from contextlib import contextmanager
+
+from jinja2 import meta
+
+from fabric.state import env
+
+from ..utils import get_cache_dir
+
+__all__ = ['RenderCache', 'get_references']
+
+# Undeclared variables and referenced templates per template source checksum
+parsed = {}
+
+# Number of byte range locks in the shared lock file, see RenderCache.lock()
+LOCK_SLOTS = 1 << 16
+
+# Byte range locks are held per process, so threads also lock slots in here
+thread_locks = {}
+
+# Renders not used for this long are evicted, unless `env.render_cache_max_age` is set
+MAX_AGE = 7 * 24 * 3600
+
+# Cache dirs already evicted by this process
+evicted = set()
+
+
+def get_references(jinja_env, templates):
+    """
+    Get sources of templates, including templates they extend, include or
+    import, and names of context variables referenced by them.
+
+    :param jinja_env: Jinja2 Environment to load templates from.
+    :param templates: Template names
+    :return: tuple(dict of template name to source, set of variable names or
+        None if not known, i.e. when templates are referenced dynamically)
+    """
+    sources = {}
+    variables = set()
+    pending = list(templates)
+    while pending:
+        template = pending.pop()
+        if template in sources:
+            continue
+
+        source = jinja_env.loader.get_source(jinja_env, template)[0]
+        sources[template] = source
+
+        key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        if key not in parsed:
+            ast = jinja_env.parse(source)
+            references = tuple(meta.find_referenced_templates(ast))
+            parsed[key] = (meta.find_undeclared_variables(ast),
+                           None if None in references else references)
+
+        undeclared, references = parsed[key]
+        if references is None:
+            variables = None
+        if variables is not None:
+            variables.update(undeclared)
+        pending.extend(references or ())
+
+    return sources, variables
+
+
+class RenderCache(object):
+    """
+    Local content addressed cache of rendered templates, shared by all
+    processes rendering with the same fabfile, i.e. fabric's parallel workers.
+
+    Keys are checksums of template sources, including referenced templates,
+    and the context variables those templates reference, as JSON.
+
+    Renders may contain secrets, so the cache is only readable by the
+    current user. Renders unused for `env.render_cache_max_age` seconds
+    (Default: a week) are evicted, once per run.
+    """
+
+    def __init__(self, jinja_env):
+        self.jinja_env = jinja_env
+        self.path = get_cache_dir('renders')
+        if self.path not in evicted:
+            evicted.add(self.path)
+            os.chmod(self.path, 0o700)
+            self.evict(env.get('render_cache_max_age') or MAX_AGE)
+
+    def get_key(self, template, context):
+        """
+        Get cache key of template rendered with given context.
+
+        :return: Key, or None if the template is not UTF-8 or the referenced
+            context is not JSON serializable, and the render therefore not
+            cacheable
+        """
+        try:
+            sources, variables = get_references(self.jinja_env, [template])
+        except UnicodeDecodeError:
+            # Left to the render to warn about
+            return None
+        if variables is not None:
+            context = dict((key, value) for key, value in context.iteritems()
+                           if key in variables)
+
+        try:
+            # Only plain values have a stable text form, unlike reprs of objects
+            context = json.dumps(context, sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+
+        checksum = hashlib.sha1(template.encode('utf-8'))
+        for name in sorted(sources):
+            checksum.update('\0{}\0'.format(name).encode('utf-8'))
+            checksum.update(sources[name].encode('utf-8'))
+        checksum.update('\0')
+        checksum.update(context)
+        return checksum.hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.path, key)
+        try:
+            with open(path, 'rb') as f:
+                text = f.read()
+        except IOError:
+            return None
+        # Mark as used, see evict()
+        os.utime(path, None)
+        return text
+
+    def set(self, key, text):
+        # Write to temp file first, to never serve a truncated render
+        path = os.path.join(self.path, key)
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(text)
+        os.rename(tmp_path, path)
+
+    def evict(self, max_age):
+        """
+        Remove renders, and left over temp files, not used within max_age seconds.
+        """
+        expired = time.time() - max_age
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                # Removed in between by another process
+                pass
+
+    @contextmanager
+    def lock(self, keys):
+        """
+        Lock cache keys across processes and threads, to render each key once
+        when rendered concurrently. Keys are mapped to byte range locks in a
+        single lock file, and a thread lock per range, acquired in order to
+        not deadlock.
+        """
+        slots = sorted(set(int(key[:8], 16) % LOCK_SLOTS for key in keys))
+        locks = [thread_locks.setdefault(slot, threading.Lock())
+                 for slot in slots]
+        for lock in locks:
+            lock.acquire()
+        try:
+            with open(os.path.join(self.path, '.lock'), 'a') as f:
+                for slot in slots:
+                    fcntl.lockf(f, fcntl.LOCK_EX, 1, slot)
+                try:
+                    yield
+                finally:
+                    for slot in slots:
+                        fcntl.lockf(f, fcntl.LOCK_UN, 1, slot)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
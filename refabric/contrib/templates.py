@@ -1,22 +1,47 @@
 import difflib
+import multiprocessing
 import os
+import pipes
+import re
 from fabric.context_managers import quiet
 import jinja2
 import shutil
+import tarfile
 import tempfile
+import threading
+import uuid
 from functools import partial
+from multiprocessing.pool import ThreadPool
 
 from fabric.colors import magenta
-from fabric.operations import put, prompt
+from fabric.context_managers import hide, settings
+from fabric.decorators import parallel
+from fabric.network import key_filenames, normalize
+from fabric.operations import local
+from fabric.state import connections, env, output
+from fabric.tasks import execute
 from fabric.utils import abort, puts, indent, warn
 
+from .manifest import Manifest, checksum
+from .. import facts
+from .render_cache import RenderCache, get_references
 from ..context_managers import silent, abort_on_error
-from ..operations import run
+from ..operations import flush_batch, prompt, put, run
+from ..parallel import execute as execute_parallel
+from ..profiling import phase
+from ..stats import recorded
 from ..utils import info
 
 IGNORED_FILES = ['.DS_Store']
 RAW_EXT = '.__raw__'
 
+# Jinja env and context inherited by forked render workers, see render_in_pool()
+render_job = None
+render_job_lock = threading.Lock()
+
+# Versions of local tools, see get_rsync_version()
+tool_versions = {}
+
 
 class FileDescriptor(str):
 
@@ -43,7 +68,7 @@ class FileDescriptor(str):
 
 
 def upload(source, destination, context=None, user=None, group=None,
-           jinja_env=None):
+           jinja_env=None, verify_remote=None, transfer=None, workers=None):
     """
     Will render and upload a local file or folder to a destination file or
     folder.
@@ -58,33 +83,282 @@ def upload(source, destination, context=None, user=None, group=None,
     :param user: User owner of destination file/folder
     :param group: Group owner of destination file/folder
     :param jinja_env: Jinja2 Environment to load templates from.
+    :param verify_remote: Check remote checksums of all files, including files
+        unchanged since last upload according to local manifest.
+        (Default: env.verify_remote or False)
+    :param transfer: How to get rendered templates to the remote, "archive"
+        for a single tarball upload, "put" for one upload per file or "rsync"
+        for a local rsync over SSH, only sending changes. Rsync requires
+        rsync >= 3.1 both locally and remote, an SSH key or agent login, and
+        passwordless sudo if `env.use_sudo` is set.
+        (Default: env.upload_transfer or "archive")
+    :param workers: Number of processes to render templates in.
+        (Default: env.render_workers or 1)
     :return: List of updated files
     """
     info('Uploading templates: {}',
          os.path.basename(source.rstrip(os.path.sep)))
 
-    tmp_dir = tempfile.mkdtemp()
+    if source.startswith('./'):
+        source = source[2:]
+
+    templates = find_templates(jinja_env, source)
+    if not templates:
+        puts(indent(magenta('No templates found')))
+        return
+
+    staging = stage(source, destination, templates, context=context,
+                    jinja_env=jinja_env, workers=workers)
+    try:
+        return push(staging, user=user, group=group,
+                    verify_remote=verify_remote, transfer=transfer)
+    finally:
+        staging.cleanup()
+
+
+def upload_hosts(source, destination, contexts, user=None, group=None,
+                 jinja_env=None, verify_remote=None, transfer=None,
+                 workers=None, pool_size=None):
+    """
+    Render and upload a local file or folder to several hosts, see upload().
+
+    Templates are rendered once per distinct context, comparing only context
+    variables referenced by the templates, and then pushed to hosts in
+    parallel. Checksum mismatches can not be prompted for in parallel and
+    aborts the host. A failing host is reported without stopping the others.
+
+    :param contexts: Dict of host string to context to render templates with.
+    :param pool_size: Max number of hosts to push to concurrently.
+        (Default: env.pool_size or all hosts)
+    :return: Dict of host string to list of updated files, or error if failed
+    """
+    info('Uploading templates: {} ({} hosts)',
+         os.path.basename(source.rstrip(os.path.sep)), str(len(contexts)))
+
+    if source.startswith('./'):
+        source = source[2:]
+
+    templates = find_templates(jinja_env, source)
+    if not templates:
+        puts(indent(magenta('No templates found')))
+        return dict((host, None) for host in contexts)
+
+    try:
+        variables = get_referenced_variables(
+            jinja_env, [t for t in templates if not t.endswith(RAW_EXT)])
+    except jinja2.TemplateNotFound as e:
+        abort('Templates not found: "{}"'.format(e))
+    except UnicodeDecodeError:
+        # Not parsable, compare full contexts and leave it to the render to warn
+        variables = None
+
+    # Render once per distinct referenced context
+    stagings = {}
+    distinct = []
+    try:
+        for host, context in contexts.iteritems():
+            if variables is not None:
+                context = dict((key, value)
+                               for key, value in context.iteritems()
+                               if key in variables)
+            for rendered_context, staging in distinct:
+                if rendered_context == context:
+                    break
+            else:
+                staging = stage(source, destination, templates,
+                                context=context, jinja_env=jinja_env,
+                                workers=workers)
+                distinct.append((context, staging))
+            stagings[host] = staging
+
+        info(indent('Rendered {} distinct context(s)'), str(len(distinct)))
+
+        @parallel(pool_size=pool_size)
+        def push_host():
+            # Push a private copy, since push removes skipped files
+            staging = stagings[env.host_string].copy()
+            try:
+                with settings(abort_on_prompts=True):
+                    return push(staging, user=user, group=group,
+                                verify_remote=verify_remote,
+                                transfer=transfer)
+            finally:
+                staging.cleanup()
+
+        results = execute_parallel(push_host, hosts=list(contexts))
+
+    finally:
+        for _, staging in distinct:
+            staging.cleanup()
+
+    updated = {}
+    failed = []
+    for host, result in results.iteritems():
+        if result is None or result.failed:
+            failed.append(host)
+            updated[host] = result and result.error
+        else:
+            updated[host] = result.value
+
+    if failed:
+        warn('Upload failed on {} host(s): {}'.format(len(failed), ', '.join(sorted(failed))))
+
+    return updated
+
+
+def download(remote_path, local_path, workers=None):
+    """
+    Download a remote file or folder. The remote tree is listed with checksums
+    in one go, files with a matching local copy are skipped, and the rest are
+    fetched concurrently.
+    Files not readable by the connected user are fetched if `env.use_sudo`
+    is set.
+
+    :param remote_path: Remote file or folder path
+    :param local_path: Local file or folder path. A remote file is
+        downloaded into local_path unless its file name is the same.
+    :param workers: Number of files to fetch concurrently.
+        (Default: env.download_workers or 4)
+    :return: List of downloaded local files
+    """
+    info('Downloading {} -> {}', remote_path, local_path)
+
+    remote_files = list_remote_files(remote_path)
+    if not remote_files:
+        abort('Remote path not found: "{}"'.format(remote_path))
+
+    # Map remote files to local files, relative to remote folder
+    root = remote_path.rstrip('/')
+    if remote_files.keys() == [root]:
+        if os.path.basename(local_path) != os.path.basename(root):
+            local_path = os.path.join(local_path, os.path.basename(root))
+        local_files = {root: local_path}
+    else:
+        local_files = dict((path, os.path.join(local_path, path[len(root) + 1:]))
+                           for path in remote_files)
+
+    # Skip files already downloaded
+    pending = [(path, local_files[path]) for path in sorted(remote_files)
+               if not os.path.isfile(local_files[path]) or
+               checksum(local_files[path]) != remote_files[path]]
+    if not pending:
+        puts(indent('(no changes found)'))
+        return []
+
+    fetch_files(pending, workers=workers)
+
+    for _, local_file in pending:
+        info(indent('Downloaded: {}'), local_file)
+
+    return [local_file for _, local_file in pending]
+
+
+def download_hosts(remote_path, local_path, hosts, workers=None,
+                   pool_size=None):
+    """
+    Download a remote file or folder from several hosts in parallel, into a
+    folder per host string within local_path, see download().
+
+    :param hosts: Hosts to download from
+    :param pool_size: Max number of hosts to download from concurrently.
+        (Default: env.pool_size or all hosts)
+    :return: Dict of host string to list of downloaded files
+    """
+    @parallel(pool_size=pool_size)
+    def download_host():
+        with settings(abort_on_prompts=True):
+            return download(remote_path,
+                            os.path.join(local_path, env.host_string, ''),
+                            workers=workers)
+
+    return execute(download_host, hosts=list(hosts))
+
+
+def find_templates(jinja_env, source):
+    """
+    Find templates to upload from given source.
+
+    :param jinja_env: Jinja2 Environment to load templates from.
+    :param source: Template path prefix
+    :return: List of template names
+    """
+    # TODO: Handle None template_loader
+    if hasattr(jinja_env.loader, 'find_templates'):
+        templates = jinja_env.loader.find_templates(source)
+    else:
+        templates = [template
+                     for template in jinja_env.loader.list_templates()
+                     if template.startswith(source)]
+    return [template for template in templates
+            if os.path.basename(template) not in IGNORED_FILES]
+
+
+def get_referenced_variables(jinja_env, templates):
+    """
+    Get names of context variables referenced by templates, including
+    templates they extend, include or import.
+
+    :param jinja_env: Jinja2 Environment to load templates from.
+    :param templates: Template names
+    :return: Set of variable names, or None if not known, i.e. when templates
+        are referenced dynamically
+    """
+    return get_references(jinja_env, templates)[1]
+
+
+class Staging(object):
+    """
+    Templates rendered into a local temp dir, ready to be pushed to a host.
+    """
+
+    def __init__(self, source, destination, templates):
+        self.source = source
+        self.destination = destination
+        self.templates = templates
+        self.tmp_dir = tempfile.mkdtemp()
+        # tuple(template, rel_template_path, is_raw, abs_destination_file,
+        #       rendered_template)
+        self.rendered = []
+
+    def copy(self):
+        """
+        Get a copy of this staging, with rendered files hard linked into a
+        new temp dir.
+        """
+        staging = Staging(self.source, self.destination, self.templates)
+        for template, rel_template_path, is_raw, abs_destination_file, \
+                rendered_template in self.rendered:
+            path = os.path.join(staging.tmp_dir, rel_template_path)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            try:
+                os.link(rendered_template, path)
+            except OSError:
+                shutil.copy(rendered_template, path)
+            staging.rendered.append((template, rel_template_path, is_raw,
+                                     abs_destination_file, path))
+        return staging
+
+    def cleanup(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+def stage(source, destination, templates, context=None, jinja_env=None,
+          workers=None):
+    """
+    Render templates into a local temp dir.
+
+    :return: Staging instance
+    """
+    for name, helper in get_jinja_helpers().iteritems():
+        jinja_env.globals.setdefault(name, helper)
 
-    jinja_env.globals.update(get_jinja_helpers())
+    staging = Staging(source, destination, templates)
+    tmp_dir = staging.tmp_dir
 
     try:
-        # TODO: Handle None template_loader
-
-        # Filter wanted templates
-        if source.startswith('./'):
-            source = source[2:]
-        templates = jinja_env.loader.list_templates()
-        templates = [template for template in templates
-                     if template.startswith(source)
-                     and os.path.basename(template) not in IGNORED_FILES]
-
-        if not templates:
-            # No templates is found
-            puts(indent(magenta('No templates found')))
-            return
-
-        dotfiles = []
-        notdotfiles = False
+        # Resolve destination of each template
+        uploads = []
         for template in templates:
             rel_template_path = template[len(source):]
             is_raw = rel_template_path.endswith(RAW_EXT)
@@ -100,146 +374,618 @@ def upload(source, destination, context=None, user=None, group=None,
                 # Single template
                 rel_template_path = os.path.basename(template)
 
-            # Render template
-            context = context or {}
-            context['n'] = os.path.splitext(os.path.basename(template))[0]
-
             abs_destination_file = destination
             if destination.endswith(os.path.sep):
                 abs_destination_file = os.path.join(destination,
                                                     rel_template_path)
 
-            # Check md5sum of file present on sure with checksum generated on
-            # last upload
-            with quiet():
-                md5_output = run('md5sum -c --status {file}.md5'
-                                 ' || test ! -e {file}.md5'
-                                 .format(file=abs_destination_file))
-            if md5_output.return_code != 0:
-                warn('Template "{}" checksum mismatch. File changed since last'
-                     ' upload.'.format(template))
-
-                skip = False
-                while True:
-                    answer = prompt('Type "yes" to overwrite, "diff" to '
-                                    'show diff, or "no" to skip:',
-                                    default='no', validate='yes|diff|no')
-                    if answer == 'diff':
-                        if is_raw:
-                            warn('Cannot show diff yet, not implemented '
-                                 'for raw files.')
-                        else:
-                            new = jinja_env.get_template(template).render(
-                                **context or {})
-                            new = new.encode('utf-8')
-                            with quiet():
-                                cur = run('cat {file}'.format(
-                                    file=abs_destination_file))
-                            df = difflib.unified_diff(
-                                cur.replace('\r', '').splitlines(True),
-                                new.splitlines(True),
-                                'current', 'new')
-                            warn(''.join(df) or 'No diff')
+            uploads.append((template, rel_template_path, is_raw,
+                            abs_destination_file))
 
-                    else:
-                        if answer == 'no':
-                            # Skip render and upload of md5 mismatched file
-                            skip = True
-                        break
-                if skip:
+        # Render templates, concurrently if more than one worker
+        texts = render_templates(jinja_env,
+                                 [entry[0] for entry in uploads
+                                  if not entry[2]],
+                                 context=context, workers=workers)
+
+        # Write rendered templates to local temp dir
+        for template, rel_template_path, is_raw, abs_destination_file \
+                in uploads:
+            rendered_template = os.path.join(tmp_dir, rel_template_path)
+
+            if is_raw:
+                tpl_path = get_source_path(jinja_env, template)
+                if tpl_path is None:
+                    continue
+                link_file(tpl_path, rendered_template)
+            else:
+                text = texts[template]
+                if text is None:
+                    warn('Failed to render template "{}"'.format(template))
                     continue
 
-            try:
-                # Write rendered template to local temp dir
-                rendered_template = os.path.join(tmp_dir, rel_template_path)
-
-                if is_raw:
-                    for tpl_base in jinja_env.loader.searchpath:
-                        tpl_path = os.path.join(tpl_base, template)
-                        if os.path.exists(tpl_path):
-                            shutil.copy(tpl_path, rendered_template)
-                            break
-                else:
-                    text = jinja_env.get_template(template).render(**context or {})
-                    text = text.encode('utf-8')
+                with file(rendered_template, 'w+') as f:
+                    f.write(text)
+                    f.write(os.linesep)  # Add newline at end removed by jinja
 
-                    with file(rendered_template, 'w+') as f:
-                        f.write(text)
-                        f.write(os.linesep)  # Add newline at end removed by jinja
+            staging.rendered.append((template, rel_template_path, is_raw,
+                                     abs_destination_file, rendered_template))
 
-                if rel_template_path[0] == '.':
-                    dotfiles.append(rendered_template)
-                else:
-                    notdotfiles = True
+    except jinja2.TemplateNotFound as e:
+        staging.cleanup()
+        abort('Templates not found: "{}"'.format(e))
+    except BaseException:
+        staging.cleanup()
+        raise
 
-            except UnicodeDecodeError:
-                warn('Failed to render template "{}"'.format(template))
+    return staging
 
-        with silent(), abort_on_error():
-            # Upload rendered templates to remote temp dir
-            remote_tmp_dir = run('mktemp -d').stdout
-            run('chmod -R 777 {}'.format(remote_tmp_dir))
-            try:
-                if notdotfiles:
-                    put(os.path.join(tmp_dir, '*'), remote_tmp_dir, use_sudo=True)
-                for dotfile in dotfiles:
-                    put(dotfile, remote_tmp_dir, use_sudo=True)
-
-                # Set given permissions on remote before sync
-                group = group or user or 'root'
-                owner = user or 'root'
-                owner = '{}:{}'.format(owner, group) if group else owner
-                run('chown -R {} "{}"'.format(owner, remote_tmp_dir))
-
-                # Clean destination
-                if len(templates) > 1 or templates[0].endswith(os.path.sep):
-                    destination = destination.rstrip(os.path.sep) + os.path.sep
-
-                # Sync templates from remote temp dir to remote destination
-                remote_tmp_dir = os.path.join(remote_tmp_dir,
-                                              '' if dotfiles else '*')
-                cmd = 'rsync -rcbiog --out-format="%n" {tmp_dir} {dest}'.format(
-                    tmp_dir=remote_tmp_dir,
-                    dest=destination)
-                updated = run(cmd)
 
-            finally:
-                # Remove temp upload dir after sync to final destination
-                run('rm -rf {}'.format(remote_tmp_dir))
-
-            updated_files = [line.strip()
-                             for line in updated.stdout.split('\n')
-                             if line]
-            updated_files = [f for f in updated_files
-                             if os.path.isfile(os.path.join(tmp_dir, f))]
-
-            if updated_files:
-                for updated_file in updated_files:
-                    updated_file_path = destination
-
-                    if destination.endswith(os.path.sep) or is_dir(destination):
-                        updated_file_path = os.path.join(destination,
-                                                         updated_file)
+def get_source_path(jinja_env, template):
+    """
+    Get source file path of a template, from the loader index if available.
+
+    :return: File path or None if not found
+    """
+    if hasattr(jinja_env.loader, 'get_source_path'):
+        return jinja_env.loader.get_source_path(template)
+
+    for tpl_base in jinja_env.loader.searchpath:
+        tpl_path = os.path.join(tpl_base, template)
+        if os.path.exists(tpl_path):
+            return tpl_path
+
+
+def link_file(source, path):
+    """
+    Stage a file without copying it, as a hard link, or a symlink if on
+    another file system. Transfers dereference staged symlinks.
+    """
+    try:
+        os.link(source, path)
+    except OSError:
+        os.symlink(os.path.realpath(source), path)
+
+
+def push(staging, user=None, group=None, verify_remote=None, transfer=None):
+    """
+    Upload staged templates to current host, skipping unchanged files and
+    prompting for files changed on remote since last upload.
+    Skipped files are removed from the staging temp dir.
+
+    :return: List of updated files
+    """
+    tmp_dir = staging.tmp_dir
+    templates = staging.templates
+    destination = staging.destination
+    rendered = list(staging.rendered)
+
+    group = group or user or 'root'
+    owner = user or 'root'
+    owner = '{}:{}'.format(owner, group) if group else owner
+
+    # Skip files unchanged since last upload, according to local manifest
+    if verify_remote is None:
+        verify_remote = env.get('verify_remote', False)
+    manifest = Manifest.load()
+    checksums = {}
+    for _, _, _, abs_destination_file, rendered_template in rendered:
+        checksums[abs_destination_file] = checksum(rendered_template)
+    if not verify_remote:
+        unchanged = [entry for entry in rendered
+                     if manifest.is_uploaded(entry[3],
+                                             checksums[entry[3]], owner)]
+        for entry in unchanged:
+            os.remove(entry[4])
+            rendered.remove(entry)
+
+    # Check md5sum of files present on remote with checksums generated on
+    # last upload, all in one go
+    changed_files = get_changed_files(
+        [entry[3] for entry in rendered])
+
+    dotfiles = []
+    notdotfiles = False
+    pending = []
+    staged_files = []
+    for template, rel_template_path, is_raw, abs_destination_file, \
+            rendered_template in rendered:
+        if abs_destination_file in changed_files:
+            warn('Template "{}" checksum mismatch. File changed since last'
+                 ' upload.'.format(template))
+
+            skip = False
+            while True:
+                answer = prompt('Type "yes" to overwrite, "diff" to '
+                                'show diff, or "no" to skip:',
+                                default='no', validate='yes|diff|no')
+                if answer == 'diff':
+                    if is_raw:
+                        warn('Cannot show diff yet, not implemented '
+                             'for raw files.')
                     else:
-                        updated_file = os.path.basename(destination)
+                        with open(rendered_template) as f:
+                            new = f.read()[:-len(os.linesep)]
+                        with quiet(), facts.read_only():
+                            cur = run('cat {file}'.format(
+                                file=abs_destination_file))
+                        df = difflib.unified_diff(
+                            cur.replace('\r', '').splitlines(True),
+                            new.splitlines(True),
+                            'current', 'new')
+                        warn(''.join(df) or 'No diff')
 
-                    info(indent('Uploaded: {}'), updated_file)
-                    # Create md5 checksum of uploaded file
+                else:
+                    if answer == 'no':
+                        # Skip upload of md5 mismatched file
+                        skip = True
+                    break
+            if skip:
+                os.remove(rendered_template)
+                continue
+
+        if rel_template_path[0] == '.':
+            dotfiles.append(rendered_template)
+        else:
+            notdotfiles = True
+        pending.append(abs_destination_file)
+        staged_files.append(rel_template_path)
+
+    if not pending:
+        puts(indent('(no changes found)'))
+        return []
+
+    with silent(), abort_on_error():
+        # Clean destination
+        if len(templates) > 1 or templates[0].endswith(os.path.sep):
+            destination = destination.rstrip(os.path.sep) + os.path.sep
+
+        # Upload rendered templates and sync them to remote destination
+        transfer = transfer or env.get('upload_transfer', 'archive')
+        with facts.writing([destination]):
+            if transfer == 'archive':
+                updated = put_archive(tmp_dir, destination, owner,
+                                      staged_files)
+            elif transfer == 'put':
+                updated = put_files(tmp_dir, destination, owner,
+                                    dotfiles, notdotfiles)
+            elif transfer == 'rsync':
+                updated = rsync_files(tmp_dir, destination, owner,
+                                      staged_files)
+                # Written by local rsync, not noticed by a remote run
+                facts.invalidate(destination)
+            else:
+                abort('Unknown upload transfer: "{}"'.format(transfer))
+
+        updated_files = [line.strip()
+                         for line in updated.splitlines()
+                         if line]
+        updated_files = [f for f in updated_files
+                         if os.path.isfile(os.path.join(tmp_dir, f))]
+
+        if updated_files:
+            for updated_file in updated_files:
+                updated_file_path = destination
+
+                if destination.endswith(os.path.sep) or is_dir(destination):
+                    updated_file_path = os.path.join(destination,
+                                                     updated_file)
+                else:
+                    updated_file = os.path.basename(destination)
+
+                info(indent('Uploaded: {}'), updated_file)
+                # Create md5 checksum of uploaded file
+                with facts.writing([updated_file_path + '.md5']):
                     run('md5sum {file} > {file}.md5'
                         .format(file=updated_file_path))
-            else:
-                puts(indent('(no changes found)'))
+        else:
+            puts(indent('(no changes found)'))
+
+        # Remember uploaded checksums
+        for abs_destination_file in pending:
+            manifest.set_uploaded(abs_destination_file,
+                                  checksums[abs_destination_file], owner)
+        manifest.save()
+
+        return updated_files
+
+
+def render_templates(jinja_env, templates, context=None, workers=None):
+    """
+    Render templates, in a pool of forked worker processes if more than one
+    worker is wanted.
+    Rendered templates are reused from the local render cache if
+    `env.render_cache` is set, see render_cache.RenderCache. Templates
+    referencing context values that are not JSON serializable are not cached.
+
+    :param jinja_env: Jinja2 Environment to load templates from.
+    :param templates: Template names
+    :param context: Context to render templates with, where `n` is set to
+        the template name without extension.
+    :param workers: Number of worker processes (Default: env.render_workers
+        or 1)
+    :return: Dict of template name to rendered text, or None if the template
+        could not be decoded
+    """
+    with phase('render'):
+        if not env.get('render_cache'):
+            return render_uncached(jinja_env, templates, context=context,
+                                   workers=workers)
+
+        return render_cached(jinja_env, templates, context=context,
+                             workers=workers)
+
+
+def render_cached(jinja_env, templates, context=None, workers=None):
+    """
+    Render templates, reusing renders from the local render cache.
+    """
+
+    cache = RenderCache(jinja_env)
+    keys = dict((template, cache.get_key(template, context or {}))
+                for template in templates)
 
-            return updated_files
+    # Concurrent renders of the same keys wait for the first to finish
+    with cache.lock([key for key in keys.values() if key]):
+        texts = {}
+        for template in templates:
+            text = cache.get(keys[template]) if keys[template] else None
+            if text is not None:
+                texts[template] = text
+
+        missing = [template for template in templates if template not in texts]
+        rendered = render_uncached(jinja_env, missing, context=context,
+                                   workers=workers)
+        for template, text in rendered.iteritems():
+            if text is not None and keys[template]:
+                cache.set(keys[template], text)
+        texts.update(rendered)
+
+    return texts
+
+
+def render_uncached(jinja_env, templates, context=None, workers=None):
+    """
+    Render templates, see render_templates().
+    """
+    workers = int(workers or env.get('render_workers') or 1)
+    context = context or {}
+
+    if workers > 1 and len(templates) > 1:
+        results = render_in_pool(jinja_env, templates, context,
+                                 min(workers, len(templates)))
+    else:
+        results = map(partial(render_template, jinja_env, context), templates)
+
+    texts = {}
+    for template, (text, error) in zip(templates, results):
+        if isinstance(error, jinja2.TemplateNotFound):
+            raise error
+        elif error:
+            abort('Failed to render template "{}": {}'.format(template, error))
+        texts[template] = text
+
+    return texts
+
+
+def render_in_pool(jinja_env, templates, context, workers):
+    """
+    Render templates in a pool of forked worker processes.
+    Jinja env and context are not picklable, so workers inherit them from
+    render_job when forked, i.e. while the pool is created. Pools are created
+    one at a time, since thread executor workers share render_job.
+
+    :return: List of tuple(text, error), in order of templates
+    """
+    global render_job
+    with render_job_lock:
+        render_job = (jinja_env, context)
+        try:
+            pool = multiprocessing.Pool(workers)
+        finally:
+            render_job = None
+
+    try:
+        return pool.map(render_template_in_worker, templates)
+    finally:
+        pool.terminate()
+
+
+def render_template(jinja_env, context, template):
+    """
+    Render template with given jinja env and context.
+
+    :return: tuple(text, error)
+    """
+    context = dict(context)
+    context['n'] = os.path.splitext(os.path.basename(template))[0]
+    try:
+        text = jinja_env.get_template(template).render(**context)
+        return text.encode('utf-8'), None
+    except UnicodeDecodeError:
+        return None, None
 
+
+def render_template_in_worker(template):
+    """
+    Render template within a worker process, with jinja env and context
+    inherited from render_job, passing errors back as result.
+    """
+    jinja_env, context = render_job
+    try:
+        return render_template(jinja_env, context, template)
     except jinja2.TemplateNotFound as e:
-        abort('Templates not found: "{}"'.format(e))
+        return None, jinja2.TemplateNotFound(e.name)
+    except Exception as e:
+        # Exception may not survive the trip back from worker, pass as text
+        return None, '{}: {}'.format(e.__class__.__name__, e)
+
+
+def put_files(tmp_dir, destination, owner, dotfiles, notdotfiles):
+    """
+    Upload rendered templates file by file to a remote temp dir and sync them
+    to destination.
+
+    :return: Output of remote rsync
+    """
+    # Upload rendered templates to remote temp dir
+    remote_tmp_dir = run('mktemp -d').stdout
+    run('chmod -R 777 {}'.format(remote_tmp_dir))
+    try:
+        if notdotfiles:
+            put(os.path.join(tmp_dir, '*'), remote_tmp_dir, use_sudo=True)
+        for dotfile in dotfiles:
+            put(dotfile, remote_tmp_dir, use_sudo=True)
+
+        # Set given permissions on remote before sync
+        run('chown -R {} "{}"'.format(owner, remote_tmp_dir))
+
+        # Sync templates from remote temp dir to remote destination
+        remote_tmp_dir = os.path.join(remote_tmp_dir,
+                                      '' if dotfiles else '*')
+        cmd = 'rsync -rcbiog --out-format="%n" {tmp_dir} {dest}'.format(
+            tmp_dir=remote_tmp_dir,
+            dest=destination)
+        return run(cmd)
+
+    finally:
+        # Remove temp upload dir after sync to final destination
+        run('rm -rf {}'.format(remote_tmp_dir))
+
+
+def put_archive(tmp_dir, destination, owner, staged_files):
+    """
+    Upload rendered templates as a single gzipped tarball, then unpack, chown
+    and sync it to destination in one remote command.
+
+    :return: Output of remote rsync
+    """
+    remote_archive = '/tmp/refabric-{}.tar.gz'.format(uuid.uuid4().hex)
+
+    with tempfile.TemporaryFile() as archive:
+        # Add top level entries one by one to not tar the temp dir itself
+        with tarfile.open(fileobj=archive, mode='w:gz',
+                          compresslevel=6, dereference=True) as tar:
+            for name in os.listdir(tmp_dir):
+                tar.add(os.path.join(tmp_dir, name), arcname=name)
+        archive.seek(0)
+        put(archive, remote_archive)
+
+    # Sync entries of folder, including dotfiles, or the only file when
+    # renamed on upload. Not the temp dir itself, to not apply its owner and
+    # mode to destination
+    if destination.endswith(os.path.sep):
+        source = '*'
+    else:
+        source = pipes.quote(staged_files[0])
+
+    cmd = ('tmp_dir=$(mktemp -d)'
+           ' && tar -xzf {archive} --no-same-owner -C $tmp_dir'
+           ' && chown -R {owner} $tmp_dir'
+           ' && shopt -s dotglob'
+           ' && rsync -rcbiog --out-format="%n" $tmp_dir/{source} {dest};'
+           ' status=$?; rm -rf $tmp_dir {archive}; exit $status').format(
+        archive=remote_archive,
+        owner=owner,
+        source=source,
+        dest=destination)
+    return run(cmd)
+
+
+def rsync_files(tmp_dir, destination, owner, staged_files):
+    """
+    Sync rendered templates from the local temp dir straight to destination
+    with a local rsync over SSH, so only changed parts of files are sent.
+    Runs remote rsync with sudo, without prompting, if `env.use_sudo` is set.
+
+    :return: Output of local rsync
+    """
+    version = get_rsync_version()
+    if version < (3, 1):
+        abort('Rsync transfer requires rsync >= 3.1, found {}'.format(
+            '.'.join(map(str, version)) if version else 'none'))
+
+    # Sync entries of folder, or the only file when renamed on upload.
+    # Not the temp dir itself, to not apply its owner and mode to destination
+    if destination.endswith(os.path.sep):
+        sources = sorted(os.listdir(tmp_dir))
+    else:
+        sources = [staged_files[0]]
+
+    user, host, port = normalize(env.host_string)
+    rsh = ['ssh']
+    if port != env.default_port:
+        rsh.append('-p {}'.format(port))
+    for key in key_filenames():
+        rsh.append('-i {}'.format(pipes.quote(key)))
+    if env.disable_known_hosts:
+        rsh.append('-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null')
+    if env.gateway:
+        gw_user, gw_host, gw_port = normalize(env.gateway)
+        rsh.append('-o ProxyCommand="ssh -p {} {}@{} nc {} {}"'.format(
+            gw_port, gw_user, gw_host, host, port))
+
+    rsync_path = 'rsync'
+    if env.get('use_sudo'):
+        rsync_path = 'sudo -n -u {} rsync'.format(env.get('sudo_user') or 'root')
+
+    remote = '[{}@{}]' if host.count(':') > 1 else '{}@{}'
+    cmd = ('rsync -rcbiogL --out-format="%n" --chown={owner}'
+           ' --rsh={rsh} --rsync-path={rsync_path}'
+           ' {sources} {remote}:{dest}').format(
+        owner=owner,
+        rsh=pipes.quote(' '.join(rsh)),
+        rsync_path=pipes.quote(rsync_path),
+        sources=' '.join(pipes.quote(os.path.join(tmp_dir, source))
+                         for source in sources),
+        remote=remote.format(user, host),
+        dest=pipes.quote(destination))
+
+    if output.running:
+        print('[{}] rsync: {}'.format(env.host_string, cmd))
+
+    with recorded('rsync', cmd, use_sudo=env.get('use_sudo')) as record, \
+            phase('transfer'), settings(warn_only=True):
+        synced = record.result(local(cmd, capture=True))
+
+    if synced.failed:
+        reason = synced.stderr.strip()
+        if env.get('use_sudo') and 'sudo' in reason:
+            reason += '\n(Rsync transfer requires passwordless sudo)'
+        abort('Rsync transfer failed: {}'.format(reason))
+
+    return synced
+
+
+def get_rsync_version():
+    """
+    Get version of local rsync, checked once per run.
+
+    :return: tuple(major, minor), or empty tuple if rsync is not installed
+    """
+    if 'rsync' not in tool_versions:
+        with settings(hide('everything'), warn_only=True):
+            version = local('rsync --version', capture=True)
+        match = re.search(r'version (\d+)\.(\d+)', version)
+        tool_versions['rsync'] = tuple(map(int, match.groups())) if match else ()
+    return tool_versions['rsync']
+
+
+def get_changed_files(paths):
+    """
+    Check md5sum of remote files against checksums generated on last upload,
+    using a single remote command.
+
+    :param paths: Absolute remote file paths
+    :return: Set of paths changed since last upload
+    """
+    if not paths:
+        return set()
+
+    # Print "<status> <path>" per file, where a non-zero status is a mismatch
+    cmd = ('for f in {files}; do'
+           ' md5sum -c --status "$f.md5" 2>/dev/null || test ! -e "$f.md5";'
+           ' echo "$? $f";'
+           ' done').format(files=' '.join(pipes.quote(path) for path in paths))
+    with quiet(), facts.read_only():
+        output = run(cmd)
+
+    paths = set(paths)
+    changed_files = set()
+    for line in output.splitlines():
+        status, _, path = line.partition(' ')
+        if status != '0' and path in paths:
+            changed_files.add(path)
+
+    return changed_files
+
+
+def list_remote_files(path):
+    """
+    List files within a remote folder, or the file itself, with checksums,
+    using a single remote command.
+
+    :return: Dict of remote file path to md5 checksum
+    """
+    cmd = 'find {} -type f -exec md5sum {{}} +'.format(pipes.quote(path.rstrip('/') or '/'))
+    with quiet(), facts.read_only():
+        listing = run(cmd)
+
+    files = {}
+    for line in listing.splitlines():
+        md5, _, remote_file = line.strip().partition('  ')
+        if remote_file:
+            files[remote_file] = md5
+    return files
+
+
+def fetch_files(files, workers=None):
+    """
+    Fetch remote files concurrently, over one SFTP session per worker on the
+    current connection. With `env.use_sudo`, files are first copied to a temp
+    dir readable by the connected user, all in one remote command.
+
+    :param files: List of (remote path, local path) tuples
+    :param workers: Number of files to fetch concurrently.
+        (Default: env.download_workers or 4)
+    """
+    workers = int(workers or env.get('download_workers') or 4)
+
+    # Fetch after commands queued by batch(), since SFTP can not be queued
+    flush_batch()
+
+    tmp_dir = None
+    if env.get('use_sudo'):
+        user = normalize(env.host_string)[0]
+        cmd = ('tmp_dir=$(mktemp -d) && cp --parents {files} $tmp_dir'
+               ' && chown -R {user} $tmp_dir && echo $tmp_dir').format(
+            files=' '.join(pipes.quote(remote) for remote, _ in files),
+            user=pipes.quote(user))
+        with silent(), abort_on_error(), facts.read_only():
+            tmp_dir = run(cmd).strip().splitlines()[-1]
+
+    transport = connections[env.host_string].get_transport()
+    thread = threading.local()
+    sessions = []
+
+    def fetch(entry):
+        remote_file, local_file = entry
+        if tmp_dir:
+            remote_file = os.path.join(tmp_dir, remote_file.lstrip('/'))
+
+        sftp = getattr(thread, 'sftp', None)
+        if sftp is None:
+            sftp = thread.sftp = transport.open_sftp_client()
+            sessions.append(sftp)
+
+        local_dir = os.path.dirname(local_file)
+        if local_dir and not os.path.isdir(local_dir):
+            try:
+                os.makedirs(local_dir)
+            except OSError:
+                # Could be created in between by another worker
+                if not os.path.isdir(local_dir):
+                    raise
+
+        with recorded('get', remote_file, sent=0) as record:
+            sftp.get(remote_file, local_file)
+            record.received = os.path.getsize(local_file)
+
+    pool = ThreadPool(min(workers, len(files)))
+    try:
+        with phase('transfer'):
+            pool.map(fetch, files)
     finally:
-        shutil.rmtree(tmp_dir)
+        pool.terminate()
+        for sftp in sessions:
+            sftp.close()
+        if tmp_dir:
+            with silent(), facts.read_only():
+                run('rm -rf {}'.format(pipes.quote(tmp_dir)))
 
 
 def is_dir(path):
-    return run('test -d %s && echo OK ; true' % path).endswith('OK')
+    return facts.is_dir(path)
 
 
 def get_jinja_helpers():
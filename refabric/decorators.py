@@ -9,3 +9,19 @@ def sudo(func, user=None):
         with ctx.sudo(user=user):
             return func(*args, **kwargs)
     return wrapper
+
+
+def rolling(waves, pool_size=None, max_failures=None):
+    """
+    Run task on hosts in rolling waves, see refabric.parallel.execute_waves().
+
+    :param waves: Hosts per wave, count or percentage of all hosts, i.e. 10 or "25%"
+    :param pool_size: Max hosts to run concurrently within a wave (Default: whole wave)
+    :param max_failures: Failed hosts tolerated before the rollout stops, count or percentage (Default: 0)
+    """
+    def decorator(func):
+        func.waves = waves
+        func.wave_pool_size = pool_size
+        func.max_failures = max_failures
+        return func
+    return decorator
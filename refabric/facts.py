@@ -0,0 +1,209 @@
+import pipes
+import threading
+from contextlib import contextmanager
+
+import fabric.operations
+from fabric.context_managers import hide, settings
+from fabric.state import env
+
+__all__ = ['exists', 'is_dir', 'is_file', 'is_link', 'user_exists', 'group_exists',
+           'os_name', 'distribution', 'prefetch', 'invalidate', 'writing', 'read_only']
+
+# Probed facts per host string, (fact name, argument, use_sudo) -> value.
+# Shared by thread executor workers, so entries are only set or popped.
+cache = {}
+
+# Paths written by remote commands within a writing() block, per thread
+local = threading.local()
+
+
+class Fact(object):
+    """
+    Read-only remote probe, printing its value as one line.
+
+    :param command: Shell command format, given the quoted argument
+    :param kind: "path" for facts about a path, "name" for users, groups etc,
+        or "static" for facts that do not change during a run, i.e. OS
+    :param parse: Function parsing printed value
+    """
+
+    def __init__(self, command, kind='path', parse=lambda value: value == '1'):
+        self.command = command
+        self.kind = kind
+        self.parse = parse
+
+    def format(self, arg):
+        if self.kind == 'path':
+            # Same path expansion as fabric.contrib.files, i.e. ~ and $HOME
+            arg = '"$(echo {})"'.format(arg)
+        elif arg is not None:
+            arg = pipes.quote(arg)
+        return self.command.format(arg)
+
+
+FACTS = {
+    'exists': Fact('stat {} >/dev/null 2>&1 && echo 1 || echo 0'),
+    'is_dir': Fact('test -d {} && echo 1 || echo 0'),
+    'is_file': Fact('test -f {} && echo 1 || echo 0'),
+    'is_link': Fact('test -L {} && echo 1 || echo 0'),
+    'user': Fact('id -u {} >/dev/null 2>&1 && echo 1 || echo 0', kind='name'),
+    'group': Fact('getent group {} >/dev/null 2>&1 && echo 1 || echo 0', kind='name'),
+    'os': Fact('uname -s', kind='static', parse=str),
+    'distribution': Fact('. /etc/os-release 2>/dev/null && echo "$ID $VERSION_ID"', kind='static', parse=str),
+}
+
+
+def get_host_cache():
+    return cache.setdefault(env.host_string, {})
+
+
+def prefetch(facts, use_sudo=False):
+    """
+    Probe facts not yet known about current host, all in one remote call.
+
+    Example:
+    >>> prefetch([('is_dir', '/etc/nginx'), ('exists', '/etc/nginx/nginx.conf'), ('os', None)])
+
+    :param facts: Iterable of (fact name, argument) tuples
+    :param use_sudo: Probe as sudo user
+    :return: Dict of (fact name, argument) to value
+    """
+    host_cache = get_host_cache()
+    facts = [(name, arg) for name, arg in facts]
+    missing = [fact for fact in facts if fact + (use_sudo,) not in host_cache]
+
+    if missing:
+        # Probe after commands queued by batch(), that may change facts
+        if env.get('batch') is not None:
+            env.batch.flush()
+
+        # Values are printed prefixed by index, since output is stripped and
+        # empty first or last values would otherwise be lost
+        script = '\n'.join('echo "{}:$({})"'.format(i, FACTS[name].format(arg))
+                           for i, (name, arg) in enumerate(missing))
+        with read_only(), settings(hide('everything'), warn_only=True, batch=None):
+            output = fabric.operations.run(script, use_sudo=use_sudo)
+
+        values = {}
+        for line in output.splitlines():
+            index, _, value = line.strip().partition(':')
+            if index.isdigit():
+                values[int(index)] = value.strip()
+
+        if set(values) != set(range(len(missing))):
+            raise ValueError('Failed to probe facts on {}: {!r}'.format(env.host_string, output))
+
+        for i, (name, arg) in enumerate(missing):
+            host_cache[(name, arg, use_sudo)] = FACTS[name].parse(values[i])
+
+    return dict((fact, host_cache[fact + (use_sudo,)]) for fact in facts)
+
+
+def get_fact(name, arg=None, use_sudo=False):
+    """
+    Get fact about current host, probed once until invalidated.
+    """
+    value = get_host_cache().get((name, arg, use_sudo), KeyError)
+    if value is KeyError:
+        value = prefetch([(name, arg)], use_sudo=use_sudo)[(name, arg)]
+    return value
+
+
+def exists(path, use_sudo=False):
+    return get_fact('exists', path, use_sudo=use_sudo)
+
+
+def is_dir(path, use_sudo=False):
+    return get_fact('is_dir', path, use_sudo=use_sudo)
+
+
+def is_file(path, use_sudo=False):
+    return get_fact('is_file', path, use_sudo=use_sudo)
+
+
+def is_link(path, use_sudo=False):
+    return get_fact('is_link', path, use_sudo=use_sudo)
+
+
+def user_exists(name):
+    return get_fact('user', name)
+
+
+def group_exists(name):
+    return get_fact('group', name)
+
+
+def os_name():
+    """
+    Get kernel name of current host, i.e. Linux or Darwin.
+    """
+    return get_fact('os')
+
+
+def distribution():
+    """
+    Get distribution id and version of current host, i.e. "ubuntu 16.04", or empty if unknown.
+    """
+    return get_fact('distribution')
+
+
+def is_within(path, parent):
+    """
+    Check if path equals parent, or is within it.
+    """
+    return (path.rstrip('/') + '/').startswith(parent.rstrip('/') + '/')
+
+
+def invalidate(path=None):
+    """
+    Forget facts about current host, that may have been changed by a remote write.
+
+    :param path: Only forget facts of given path and its contents
+        (Default: all facts except static ones)
+    """
+    host_cache = cache.get(env.host_string)
+    if not host_cache:
+        return
+
+    for key in host_cache.keys():
+        fact = FACTS[key[0]]
+        if fact.kind == 'static':
+            continue
+        if path is None or (fact.kind == 'path' and is_within(key[1], path)):
+            host_cache.pop(key, None)
+
+
+def invalidate_written():
+    """
+    Forget facts possibly changed by a remote command, called for every run/sudo.
+    Commands are assumed to change anything, unless declared by writing().
+    """
+    paths = getattr(local, 'paths', None)
+    if paths is None:
+        invalidate()
+    else:
+        for path in paths:
+            invalidate(path)
+
+
+@contextmanager
+def writing(paths):
+    """
+    Declare remote paths written by commands within block, to only forget facts
+    of those paths instead of all facts.
+
+    :param paths: Remote paths
+    """
+    previous = getattr(local, 'paths', None)
+    local.paths = paths
+    try:
+        yield
+    finally:
+        local.paths = previous
+
+
+def read_only():
+    """
+    Declare commands within block as not changing anything remote.
+    """
+    return writing(())
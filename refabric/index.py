@@ -0,0 +1,203 @@
+import json
+import os
+import pkgutil
+
+from fabric.state import env
+from fabric.task_utils import _Dict
+from fabric.tasks import Task, WrappedCallableTask
+
+from .utils import get_cache_dir
+
+__all__ = ['TaskIndex', 'IndexedTask', 'get_task_index']
+
+task_index = None
+
+
+def get_task_index():
+    """
+    Get task index of current fabfile, loaded once.
+    """
+    global task_index
+    if task_index is None:
+        task_index = TaskIndex.load()
+    return task_index
+
+
+def get_source_mtime(package):
+    """
+    Get latest modification time of a blueprint module, or any module within
+    a blueprint package, without importing it.
+
+    :param package: Dotted module/package name
+    :return: Modification time or None if source not found
+    """
+    try:
+        loader = pkgutil.get_loader(package)
+        filename = loader.get_filename(package)
+    except (AttributeError, ImportError):
+        return None
+
+    if not loader.is_package(package):
+        return os.path.getmtime(filename)
+
+    mtimes = []
+    for root, _, files in os.walk(os.path.dirname(filename)):
+        mtimes.extend(os.path.getmtime(os.path.join(root, f)) for f in files if f.endswith('.py'))
+    return max(mtimes)
+
+
+class TaskIndex(dict):
+    """
+    Local record of blueprint task names and docstrings, making it possible
+    to list and dispatch tasks without importing every blueprint.
+    Entries are only valid as long as fabfile and blueprint sources are unchanged.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TaskIndex, self).__init__(*args, **kwargs)
+        self.path = os.path.join(get_cache_dir(), 'tasks.json')
+
+    @classmethod
+    def load(cls):
+        index = cls()
+        if os.path.exists(index.path):
+            with open(index.path) as f:
+                try:
+                    index.update(json.load(f))
+                except ValueError:
+                    pass  # Corrupt index, rebuilt on save
+        return index
+
+    def get_key(self, package):
+        """
+        Get validation key for a blueprint package, based on fabfile and blueprint source mtimes.
+        """
+        fabfile = env.get('real_fabfile')
+        mtime = get_source_mtime(package)
+        if mtime is None:
+            return None
+        return [fabfile, fabfile and os.path.getmtime(fabfile), mtime]
+
+    def get_tasks(self, blueprint):
+        """
+        Get placeholder tasks for a blueprint, if indexed and still valid.
+
+        :param blueprint: LazyBlueprint instance
+        :return: Task mapping of IndexedTask placeholders or None
+        """
+        entry = self.get(blueprint.package)
+        if not entry or entry['key'] != self.get_key(blueprint.package):
+            return None
+
+        # Same as importing a blueprint with new-style tasks would do
+        if entry['new_style']:
+            env.new_style_tasks = True
+
+        return build_tasks(blueprint, entry['tasks'])
+
+    def set_tasks(self, blueprint, tasks, default=None):
+        """
+        Index loaded tasks of a blueprint.
+
+        :param blueprint: LazyBlueprint instance
+        :param tasks: Loaded task mapping
+        :param default: Default task of blueprint
+        """
+        key = self.get_key(blueprint.package)
+        if key is not None:
+            self[blueprint.package] = {
+                'key': key,
+                'new_style': bool(env.get('new_style_tasks')),
+                'tasks': dump_tasks(tasks, default),
+            }
+
+    def save(self):
+        # Write to temp file first, to never leave a truncated index behind
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+def dump_tasks(tasks, default=None):
+    """
+    Serialize a task mapping into names, docstrings and default task name.
+    """
+    entries = {}
+    for name, task in tasks.iteritems():
+        if isinstance(task, dict):
+            entries[name] = dump_tasks(task, getattr(task, 'default', None))
+        else:
+            doc = getattr(task, '__doc__', None)
+            entries[name] = {'doc': doc if isinstance(doc, basestring) else None}
+
+    default = next((name for name, task in tasks.iteritems() if task is default), None)
+    return {'tasks': entries, 'default': default}
+
+
+def build_tasks(blueprint, node, path=()):
+    """
+    Build a task mapping of placeholders from a serialized node, see dump_tasks().
+    """
+    tasks = _Dict()
+    for name, entry in node['tasks'].iteritems():
+        name = str(name)
+        if 'tasks' in entry:
+            tasks[name] = build_tasks(blueprint, entry, path + (name,))
+        else:
+            tasks[name] = IndexedTask(blueprint, path + (name,), entry['doc'])
+
+    if node['default']:
+        tasks.default = tasks[str(node['default'])]
+
+    return tasks
+
+
+class IndexedTask(Task):
+    """
+    Placeholder of an indexed blueprint task, carrying name and docstring only.
+    The blueprint is imported and the real task used as soon as anything else is needed.
+    """
+
+    def __init__(self, blueprint, path, doc):
+        super(IndexedTask, self).__init__(name=path[-1])
+        self.blueprint = blueprint
+        self.path = path
+        self.__doc__ = doc
+
+    def resolve(self):
+        """
+        Import blueprint and get real task.
+        """
+        if 'task' not in self.__dict__:
+            self.blueprint.load()
+            task = self.blueprint
+            for name in self.path:
+                task = task[name]
+
+            if not isinstance(task, Task):
+                task = WrappedCallableTask(task)
+
+            self.task = task
+
+        return self.task
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __details__(self):
+        return self.resolve().__details__()
+
+    def __getattr__(self, item):
+        if item.startswith('__') or item in ('blueprint', 'path', 'task'):
+            raise AttributeError(item)
+        return getattr(self.resolve(), item)
+
+    def run(self, *args, **kwargs):
+        return self.resolve().run(*args, **kwargs)
+
+    def get_hosts_and_effective_roles(self, *args, **kwargs):
+        return self.resolve().get_hosts_and_effective_roles(*args, **kwargs)
+
+    def get_pool_size(self, hosts, default):
+        return self.resolve().get_pool_size(hosts, default)
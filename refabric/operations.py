@@ -1,9 +1,27 @@
+from glob import glob
+from itertools import groupby
+import os
+import uuid
+
 import fabric.operations
-from fabric.state import env
+from fabric.context_managers import settings, hide
+from fabric.operations import _prefix_commands, _prefix_env_vars
+from fabric.state import connections, env, output
+from fabric.utils import error
 
+from . import facts
 from .context_managers import silent
+from .profiling import phase
+from .stats import recorded
+
+__all__ = ['run', 'put', 'get', 'prompt', 'Batch', 'BatchResult']
 
-__all__ = ['run']
+# Current owner of the forwarded SSH agent socket, per host and connection.
+# The agent socket is created per SSH connection, so a reconnect (new transport) means a new socket.
+agent_socket_owners = {}
+
+# Keyword arguments of run/sudo honoured for batched commands, see Batch
+BATCH_KWARGS = ('warn_only', 'quiet')
 
 
 def run(command, shell=True, pty=True, combine_stderr=None, use_sudo=False, user=None, **kwargs):
@@ -12,18 +30,254 @@ def run(command, shell=True, pty=True, combine_stderr=None, use_sudo=False, user
     """
     use_sudo = use_sudo or user is not None or env.get('use_sudo')
 
+    # Forget remote facts the command may change
+    facts.invalidate_written()
+
+    if env.get('batch') is not None:
+        if shell and all(key in BATCH_KWARGS or value is None for key, value in kwargs.items()):
+            # Queue command, to be shipped with the rest of the batch
+            if use_sudo:
+                user = user or env.get('sudo_user', env.user)
+            return env.batch.add(command, use_sudo=use_sudo, user=user,
+                                 warn_only=kwargs.get('warn_only', False), quiet=kwargs.get('quiet', False))
+
+        # Options a batch can not honour, i.e. timeout, run command on its own after the queued ones
+        flush_batch()
+        with settings(batch=None):
+            return run(command, shell=shell, pty=pty, combine_stderr=combine_stderr, use_sudo=use_sudo,
+                       user=user, **kwargs)
+
     if not use_sudo:
-        return fabric.operations.run.original(command, shell=shell, pty=pty, combine_stderr=combine_stderr, **kwargs)
+        with recorded('run', command) as record, phase('ssh'):
+            return record.result(fabric.operations.run.original(command, shell=shell, pty=pty,
+                                                                combine_stderr=combine_stderr, **kwargs))
 
     else:
         user = user or env.get('sudo_user', env.user)
-        # Make SSH agent socket available to the sudo user
-        with silent():
-            fabric.operations.sudo.original('chown -R {}: $(dirname $SSH_AUTH_SOCK)'.format(user), user='root',
-                                            **kwargs)
+        # Make SSH agent socket available to the sudo user, unless already handed over on this connection
+        if not is_agent_socket_owner(user):
+            chown = 'chown -R {}: $(dirname $SSH_AUTH_SOCK)'.format(user)
+            with silent(), recorded('sudo', chown, use_sudo=True, user='root') as record, phase('ssh'):
+                record.result(fabric.operations.sudo.original(chown, user='root', **kwargs))
+            if env.host_string:
+                agent_socket_owners[env.host_string] = (connections[env.host_string].get_transport(), user)
+
+        with recorded('sudo', command, use_sudo=True, user=user) as record, phase('ssh'):
+            if user == env.user:
+                user = None
+
+            return record.result(fabric.operations.sudo.original(command, shell=shell, pty=pty,
+                                                                 combine_stderr=combine_stderr, user=user, **kwargs))
+
+
+def put(local_path=None, remote_path=None, use_sudo=False, *args, **kwargs):
+    """
+    Patched version of fabric.operations.put.
+    Records transfer stats and profiles transfer time, see refabric.stats and refabric.profiling.
+    Forgets remote facts of the destination, see refabric.facts.
+    Runs commands queued by batch() first, i.e. creating the destination.
+    """
+    flush_batch()
+    with recorded('put', remote_path or '', use_sudo=use_sudo, sent=get_local_size(local_path)) as record, \
+            phase('transfer'):
+        uploaded = fabric.operations.put.original(local_path, remote_path, use_sudo, *args, **kwargs)
+        facts.invalidate(remote_path)
+        record.return_code = 1 if uploaded.failed else 0
+        return uploaded
+
+
+def get(remote_path, local_path=None, use_sudo=False, *args, **kwargs):
+    """
+    Patched version of fabric.operations.get.
+    Records transfer stats and profiles transfer time, see refabric.stats and refabric.profiling.
+    Runs commands queued by batch() first, i.e. creating the remote file.
+    """
+    flush_batch()
+    with recorded('get', remote_path, use_sudo=use_sudo, sent=0) as record, phase('transfer'):
+        downloaded = fabric.operations.get.original(remote_path, local_path, use_sudo, *args, **kwargs)
+        record.return_code = 1 if downloaded.failed else 0
+        return downloaded
+
+
+def flush_batch():
+    """
+    Run commands queued by batch(), before operations that can not be queued.
+    """
+    if env.get('batch') is not None:
+        env.batch.flush()
+
+
+def prompt(*args, **kwargs):
+    """
+    Patched version of fabric.operations.prompt.
+    Profiles time waiting for input, see refabric.profiling.
+    """
+    with phase('prompt'):
+        return fabric.operations.prompt.original(*args, **kwargs)
+
+
+def get_local_size(local_path):
+    """
+    Get total size in bytes of local file(s) to put, by path, glob or file-like object.
+    """
+    if local_path is None:
+        return 0
+
+    if not isinstance(local_path, basestring):
+        position = local_path.tell()
+        local_path.seek(0, os.SEEK_END)
+        size = local_path.tell() - position
+        local_path.seek(position)
+        return size
+
+    size = 0
+    for path in glob(os.path.expanduser(local_path)):
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        else:
+            size += os.path.getsize(path)
+    return size
+
+
+def is_agent_socket_owner(user):
+    """
+    Check if forwarded SSH agent socket on current connection already is handed over to given user.
+    """
+    if not env.host_string or env.host_string not in agent_socket_owners:
+        return False
+    transport = connections[env.host_string].get_transport()
+    return transport is not None and transport.is_active() and \
+        agent_socket_owners[env.host_string] == (transport, user)
+
+
+class Batch(object):
+    """
+    Queue of remote commands, shipped as one remote script per sudo user on
+    flush.
+    """
+
+    def __init__(self):
+        self.queue = []
+
+    def add(self, command, use_sudo=False, user=None, warn_only=False, quiet=False):
+        """
+        Queue command, with current cd/prefix/shell_env context applied.
+
+        :param warn_only: Do not abort on failure, as run/sudo(warn_only=True)
+        :param quiet: Do not print command and abort on failure, as run/sudo(quiet=True)
+        :return: BatchResult, populated on flush
+        """
+        command = _prefix_env_vars(_prefix_commands(command, 'remote'))
+        result = BatchResult(self, command, warn_only=warn_only or quiet or env.warn_only,
+                             quiet=quiet or not output.running)
+        self.queue.append((use_sudo, user, result))
+        return result
+
+    def flush(self):
+        """
+        Run queued commands, one remote script for each consecutive run of
+        commands sharing the same sudo user.
+        """
+        queue, self.queue = self.queue, []
+        for (use_sudo, user), commands in groupby(queue, lambda q: q[:2]):
+            self.ship([result for _, _, result in commands],
+                      use_sudo=use_sudo, user=user)
+
+    def ship(self, results, use_sudo=False, user=None):
+        which = 'sudo' if use_sudo else 'run'
+        marker = uuid.uuid4().hex
+
+        # Run each command in a subshell, followed by a marker line holding
+        # its index and return code, and stop at first unexpected failure
+        script = []
+        for i, result in enumerate(results):
+            if not result.quiet:
+                print("[%s] %s: %s" % (env.host_string, which, result.command))
+            script.append('(\n{}\n)'.format(result.command))
+            script.append('status=$?; echo; echo {} {} $status'.format(marker, i))
+            if not result.warn_only:
+                script.append('[ $status -eq 0 ] || exit $status')
+
+        with settings(hide('running', 'stdout'), warn_only=True, batch=None,
+                      cwd='', command_prefixes=[], shell_env={}, path=''):
+            out = run('\n'.join(script), use_sudo=use_sudo, user=user)
+
+        # Split output per command
+        lines = []
+        statuses = {}
+        for line in out.splitlines():
+            if line.startswith(marker):
+                _, i, status = line.split()
+                statuses[int(i)] = ('\n'.join(lines).strip(), int(status))
+                lines = []
+            else:
+                lines.append(line)
+
+        for i, result in enumerate(results):
+            stdout, status = statuses.get(i, ('', None))
+            result.resolve(stdout, status, real_command=out.real_command)
+
+        for result in results:
+            if result.failed and not result.warn_only:
+                msg = '{}() received nonzero return code {} while executing ' \
+                      'batched command!\n\nRequested: {}'.format(
+                          which, result.return_code, result.command)
+                with settings(warn_only=False):
+                    error(message=msg, stdout=result.stdout)
+
+
+class BatchResult(object):
+    """
+    Result of a batched command, mirroring fabric's run/sudo output string.
+    Accessing the result before its batch is flushed will flush the batch.
+    """
+
+    def __init__(self, batch, command, warn_only=False, quiet=False):
+        self.batch = batch
+        self.command = command
+        self.warn_only = warn_only
+        self.quiet = quiet
+        self.pending = True
+
+    def resolve(self, stdout, return_code, real_command=None):
+        self.pending = False
+        self.stdout = fabric.operations._AttributeString(stdout)
+        self.stderr = fabric.operations._AttributeString('')
+        self.return_code = return_code
+        self.real_command = real_command
+        self.failed = return_code not in env.ok_ret_codes
+        self.succeeded = not self.failed
+
+    def __getattr__(self, item):
+        if self.pending:
+            self.batch.flush()
+            if self.pending:
+                raise AttributeError(item)
+            return getattr(self, item)
+        # Fallback on string methods, i.e. result.splitlines()
+        return getattr(self.stdout, item)
+
+    def __str__(self):
+        return str(self.stdout)
+
+    def __repr__(self):
+        return repr(self.stdout)
+
+    def __eq__(self, other):
+        return str(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __len__(self):
+        return len(str(self))
+
+    def __iter__(self):
+        return iter(str(self))
 
-        if user == env.user:
-            user = None
+    def __contains__(self, item):
+        return item in str(self)
 
-        return fabric.operations.sudo.original(command, shell=shell, pty=pty, combine_stderr=combine_stderr,
-                                               user=user, **kwargs)
+    def __nonzero__(self):
+        return bool(str(self))
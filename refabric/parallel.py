@@ -0,0 +1,321 @@
+import copy
+import multiprocessing
+import sys
+import threading
+import traceback
+
+import fabric.state
+import fabric.tasks
+from fabric.context_managers import settings
+from fabric.task_utils import crawl, parse_kwargs
+from fabric.tasks import Task, WrappedCallableTask
+from fabric.utils import abort, warn
+
+from .utils import info, resolver
+
+__all__ = ['execute', 'execute_waves', 'HostResult']
+
+# Per thread copies of env and output, within thread executor workers
+worker = threading.local()
+
+# Number of running workers, to skip overlay lookups when there are none
+running = [0]
+running_lock = threading.Lock()
+
+
+def get_overlay(dikt):
+    """
+    Get current worker's private copy of given dict, if any.
+    """
+    overlays = getattr(worker, 'overlays', None)
+    if overlays:
+        return overlays.get(id(dikt))
+
+
+def copy_dict(dikt):
+    """
+    Deep copy dict values, falling back on sharing values that can not be copied.
+    """
+    copied = {}
+    for key, value in dikt.items():
+        try:
+            copied[key] = copy.deepcopy(value)
+        except Exception:
+            copied[key] = value
+    return copied
+
+
+def overlaid(name):
+    """
+    Make patched version of a dict method, applied on the worker's private
+    copy of the dict when called within a thread executor worker.
+    """
+    def method(self, *args, **kwargs):
+        overlay = get_overlay(self) if running[0] else None
+        if overlay is None:
+            return method.original(self, *args, **kwargs)
+        return getattr(overlay, name)(*args, **kwargs)
+
+    method.__name__ = name
+    return staticmethod(method)
+
+
+class _AttributeDict(object):
+    """
+    Patched version (mixin) of fabric.utils._AttributeDict.
+    Isolates env (and output) per thread executor worker.
+    """
+    __getitem__ = overlaid('__getitem__')
+    __setitem__ = overlaid('__setitem__')
+    __delitem__ = overlaid('__delitem__')
+    __contains__ = overlaid('__contains__')
+    __iter__ = overlaid('__iter__')
+    __len__ = overlaid('__len__')
+    __repr__ = overlaid('__repr__')
+    get = overlaid('get')
+    has_key = overlaid('has_key')
+    keys = overlaid('keys')
+    values = overlaid('values')
+    items = overlaid('items')
+    iterkeys = overlaid('iterkeys')
+    itervalues = overlaid('itervalues')
+    iteritems = overlaid('iteritems')
+    setdefault = overlaid('setdefault')
+    update = overlaid('update')
+    pop = overlaid('pop')
+    popitem = overlaid('popitem')
+    clear = overlaid('clear')
+    copy = overlaid('copy')
+
+
+class HostConnectionCache(object):
+    """
+    Patched version (mixin) of fabric.network.HostConnectionCache.
+    """
+
+    @staticmethod
+    def clear(self):
+        """
+        Connections are shared by thread executor workers, one host each,
+        so keep other workers' connections when a worker starts.
+        """
+        if getattr(worker, 'overlays', None) is None:
+            HostConnectionCache.clear.original(self)
+
+
+class WorkerThread(multiprocessing.Process):
+    """
+    Thread posing as the multiprocessing.Process fabric's JobQueue expects,
+    running its target with private copies of env and output.
+    """
+
+    def start(self):
+        # Copy now, JobQueue sets host_string for the job around start()
+        self.overlays = {
+            id(fabric.state.env): copy_dict(fabric.state.env),
+            id(fabric.state.output): copy_dict(fabric.state.output),
+        }
+        self.code = None
+        self.thread = threading.Thread(target=self.bootstrap, name=self.name)
+        self.thread.daemon = True
+        with running_lock:
+            running[0] += 1
+        self.thread.start()
+
+    def bootstrap(self):
+        worker.overlays = self.overlays
+        resolver.local.resolvers = {}
+        try:
+            self.run()
+            self.code = 0
+        except SystemExit as e:
+            self.code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+            self.code = 1
+        finally:
+            sys.stdout.flush()
+            with running_lock:
+                running[0] -= 1
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+    @property
+    def exitcode(self):
+        return self.code
+
+
+class Threads(object):
+    """
+    Stand-in for the multiprocessing module given to fabric.tasks._execute,
+    to run parallel hosts on threads, see refabric.tasks._execute.
+    """
+    Process = WorkerThread
+
+
+class HostResult(object):
+    """
+    Outcome of a task on one host.
+    """
+
+    def __init__(self, host, value=None, error=None):
+        self.host = host
+        self.value = value
+        self.error = error
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.failed:
+            return '<HostResult {} failed: {!r}>'.format(self.host, self.error)
+        return '<HostResult {}: {!r}>'.format(self.host, self.value)
+
+
+class CapturingTask(Task):
+    """
+    Task wrapper returning a HostResult, instead of aborting, per host.
+    """
+
+    def __init__(self, task):
+        super(CapturingTask, self).__init__(name=task.name)
+        self.task = task
+        self.__doc__ = task.__doc__
+
+    def __getattr__(self, item):
+        if item.startswith('__') or item == 'task':
+            raise AttributeError(item)
+        return getattr(self.task, item)
+
+    def run(self, *args, **kwargs):
+        host = fabric.state.env.host_string
+        try:
+            return HostResult(host, value=self.task.run(*args, **kwargs))
+        except BaseException as e:
+            return HostResult(host, error=e)
+
+    def get_hosts_and_effective_roles(self, *args, **kwargs):
+        return self.task.get_hosts_and_effective_roles(*args, **kwargs)
+
+    def get_pool_size(self, hosts, default):
+        return self.task.get_pool_size(hosts, default)
+
+
+def get_task(task):
+    """
+    Get Task instance of task, callable or task name.
+    """
+    if isinstance(task, basestring):
+        name, task = task, crawl(task, fabric.state.commands)
+        if task is None:
+            abort('{!r} is not a valid task name'.format(name))
+    if not isinstance(task, Task):
+        task = WrappedCallableTask(task)
+    return task
+
+
+def execute(task, *args, **kwargs):
+    """
+    Execute task in parallel, like fabric.tasks.execute, on the thread executor
+    unless `env.executor` is set otherwise. Failing hosts do not abort others.
+
+    :param task: Task, callable or task name
+    :return: Dict of host string to HostResult
+    """
+    task = get_task(task)
+    executor = fabric.state.env.get('executor') or 'threads'
+    with settings(parallel=True, executor=executor):
+        return fabric.tasks.execute(CapturingTask(task), *args, **kwargs)
+
+
+class WaveTask(CapturingTask):
+    """
+    Task wrapper running one wave of hosts in parallel, see execute_waves().
+    """
+    waves = None
+    parallel = True
+    serial = False
+
+    def __init__(self, task, hosts, roles, pool_size=None):
+        super(WaveTask, self).__init__(task)
+        self.wave_hosts = hosts
+        self.wave_roles = roles
+        self.wave_pool_size = pool_size
+
+    def get_hosts_and_effective_roles(self, *args, **kwargs):
+        return self.wave_hosts, self.wave_roles
+
+    def get_pool_size(self, hosts, default):
+        return min(int(self.wave_pool_size or len(hosts)), len(hosts))
+
+
+def get_amount(value, total):
+    """
+    Get amount from a count or a percentage of total, i.e. 10 or "25%".
+    """
+    value = str(value).strip()
+    if value.endswith('%'):
+        return int(total * float(value[:-1]) / 100)
+    return int(value)
+
+
+def execute_waves(task, waves, *args, **kwargs):
+    """
+    Execute task on hosts in rolling waves. Hosts within a wave run in
+    parallel, and the rollout stops when more hosts than tolerated have failed.
+
+    :param task: Task instance
+    :param waves: Hosts per wave, count or percentage of all hosts,
+        i.e. 10 or "25%"
+    :param pool_size: Max hosts to run concurrently within a wave, read from
+        task or `env.wave_pool_size` (Default: whole wave)
+    :param max_failures: Failed hosts tolerated, count or percentage of all
+        hosts, read from task or `env.max_failures` (Default: 0)
+    :return: Dict of host string to task return value, or error if failed
+    """
+    env = fabric.state.env
+    kwargs, hosts, roles, exclude_hosts = parse_kwargs(kwargs)
+    with settings(prompt_hosts=False):
+        all_hosts, effective_roles = task.get_hosts_and_effective_roles(
+            hosts, roles, exclude_hosts, env)
+
+    pool_size = getattr(task, 'wave_pool_size', None) or env.get('wave_pool_size')
+    max_failures = getattr(task, 'max_failures', None) or env.get('max_failures') or 0
+    max_failures = get_amount(max_failures, len(all_hosts))
+    size = max(get_amount(waves, len(all_hosts)), 1)
+    batches = [all_hosts[i:i + size] for i in range(0, len(all_hosts), size)]
+
+    results = {}
+    failed = []
+    for i, batch in enumerate(batches, start=1):
+        info('Wave {}/{}: {}', str(i), str(len(batches)), ', '.join(batch))
+        wave_task = WaveTask(task, batch, effective_roles, pool_size=pool_size)
+        with settings(parallel=True, waves=None):
+            wave_results = fabric.tasks.execute(wave_task, *args, **kwargs)
+
+        for host, result in wave_results.iteritems():
+            if result is None or result.failed:
+                failed.append(host)
+                results[host] = result and result.error
+            else:
+                results[host] = result.value
+
+        if len(failed) > max_failures:
+            skipped = sum(len(b) for b in batches[i:])
+            abort('Rollout stopped after wave {}/{}, {} host(s) failed: {} '
+                  '({} host(s) skipped)'.format(i, len(batches), len(failed),
+                                                ', '.join(failed), skipped))
+        elif failed:
+            warn('{} host(s) failed so far: {}'.format(len(failed),
+                                                       ', '.join(failed)))
+
+    return results
@@ -0,0 +1,162 @@
+import atexit
+import os
+import threading
+import time
+
+from fabric.state import env
+
+__all__ = ['phase', 'ProfiledTask', 'report']
+
+# Phase stack and self times of current thread, see Phase
+local = threading.local()
+
+# Self times are spooled to a file shared with parallel workers,
+# and merged by the main process on exit
+main_pid = os.getpid()
+spool_name = '{}-{}.folded'.format(main_pid, int(time.time()))
+spool_lock = threading.Lock()
+spooled = set()
+
+
+def is_enabled():
+    """
+    Check if executed tasks are profiled, enabled by setting `env.profile`
+    to an output path, i.e. `$ fab --set profile=deploy.folded ...`.
+    """
+    return bool(env.get('profile'))
+
+
+def get_spool_path():
+    from .utils import get_cache_dir
+    return os.path.join(get_cache_dir('profile'), spool_name)
+
+
+class Phase(object):
+    """
+    Frame of the phase stack, adding its self time, excluding nested
+    phases, to the stack path on exit.
+    """
+
+    def __init__(self, name):
+        self.name = name.replace(';', ':').replace(' ', '_')
+
+    def __enter__(self):
+        # Forked parallel workers start over with a stack of their own
+        if getattr(local, 'pid', None) != os.getpid():
+            local.pid = os.getpid()
+            local.stack = []
+            local.times = {}
+        local.stack.append([self.name, time.time(), 0.0])
+
+    def __exit__(self, *exc_info):
+        stack = local.stack
+        path = ';'.join(frame[0] for frame in stack)
+        _, start, nested = stack.pop()
+        elapsed = time.time() - start
+        local.times[path] = local.times.get(path, 0.0) + elapsed - nested
+
+        if stack:
+            stack[-1][2] += elapsed
+        else:
+            # Task done, spool its times
+            times, local.times = local.times, {}
+            spool(times)
+
+
+class NoPhase(object):
+    """
+    Stand-in phase outside of profiled tasks.
+    """
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+no_phase = NoPhase()
+
+
+def phase(name):
+    """
+    Profile block as a phase of the current task, i.e. render, settings, ssh,
+    transfer or prompt. Time not spent in a phase is left to the task itself.
+
+    :param name: Phase name
+    :return: Context manager
+    """
+    if getattr(local, 'stack', None) and local.pid == os.getpid():
+        return Phase(name)
+    return no_phase
+
+
+class ProfiledTask(object):
+    """
+    Task wrapper profiling its run as the root of a phase stack, see refabric.tasks._execute.
+    """
+
+    def __init__(self, task, name):
+        self.task = task
+        self.name = name
+
+    def __getattr__(self, item):
+        return getattr(self.task, item)
+
+    def run(self, *args, **kwargs):
+        with Phase(self.name):
+            return self.task.run(*args, **kwargs)
+
+
+def spool(times):
+    lines = ''.join('{} {}\n'.format(path, int(seconds * 1000000))
+                    for path, seconds in times.iteritems())
+    with spool_lock:
+        path = get_spool_path()
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        spooled.add(path)
+        try:
+            os.write(fd, lines)
+        finally:
+            os.close(fd)
+
+
+def report():
+    """
+    Write spooled self times, in microseconds, as collapsed stacks to `env.profile`,
+    ready for flamegraph.pl or speedscope. Called on exit of the main process,
+    removing the spool even if profiling got disabled during the run.
+    """
+    if os.getpid() != main_pid or not (is_enabled() or spooled):
+        return
+
+    paths = spooled | set([get_spool_path()])
+    try:
+        if is_enabled():
+            write_profile(get_spool_path())
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def write_profile(path):
+    if not os.path.exists(path):
+        return
+
+    times = {}
+    with open(path) as f:
+        for line in f:
+            stack, _, micros = line.rpartition(' ')
+            if stack:
+                times[stack] = times.get(stack, 0) + int(micros)
+
+    with open(env.profile, 'w') as f:
+        for stack in sorted(times):
+            f.write('{} {}\n'.format(stack, times[stack]))
+
+    from .utils import info
+    info('Profile written to {}', env.profile)
+
+
+atexit.register(report)
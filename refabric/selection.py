@@ -0,0 +1,117 @@
+import fnmatch
+import re
+
+__all__ = ['HostIndex']
+
+RANGE_PATTERN = re.compile(r'^(\d*)-(\d*)$')
+TERM_SEPARATORS = re.compile(r'[,\s]+')
+
+
+class HostIndex(object):
+    """
+    Host list indexed for selection expressions.
+
+    An expression is a comma or space separated list of terms, each a
+    selector or an intersection of selectors joined by `&`. Terms prefixed
+    with `!` are excluded from the union of the other terms (or all hosts).
+
+    Selectors:
+        *           All hosts, or 0 when given as the whole expression
+        3, 3-7      1-based index, or inclusive range; open ended as 3- or -7
+        @web        Hosts of role web
+        web-*       Host glob
+        web-1       Host name
+
+    Example: "@web&*.se !web-3,1-2"
+    """
+
+    def __init__(self, hosts, roledefs=None):
+        self.hosts = list(hosts)
+        self.positions = dict((host, i) for i, host in enumerate(self.hosts))
+        self.roledefs = roledefs or {}
+
+    def select(self, expression):
+        """
+        Select hosts by expression.
+
+        :param expression: Selection expression
+        :return: Selected hosts, in host list order
+        """
+        if expression.strip() == '0':
+            return list(self.hosts)
+
+        included = []
+        excluded = set()
+        for term in TERM_SEPARATORS.split(expression.strip()):
+            if not term:
+                continue
+            negate = term.startswith('!')
+            factors = (term[1:] if negate else term).split('&')
+            hosts = reduce(set.intersection, (self.match(f) for f in factors))
+            if negate:
+                excluded.update(hosts)
+            else:
+                included.append(hosts)
+
+        selected = set.union(*included) if included else set(self.hosts)
+        selected -= excluded
+        if not selected:
+            raise ValueError('Host selection {!r} matches no hosts'.format(expression))
+
+        return sorted(selected, key=self.positions.get)
+
+    def match(self, selector):
+        """
+        Get hosts matching a single selector.
+
+        :return: Set of hosts
+        """
+        if not selector:
+            raise ValueError('Empty host selector')
+
+        if selector == '*':
+            return set(self.hosts)
+
+        if selector == '0':
+            # Used to be ignored within a list, reject rather than select all
+            raise ValueError('Selector 0 (all hosts) can not be combined with others')
+
+        if selector in self.positions:
+            return {selector}
+
+        if selector.startswith('@'):
+            return self.match_role(selector[1:])
+
+        if selector.isdigit():
+            return set(self.slice(selector, selector))
+
+        match = RANGE_PATTERN.match(selector)
+        if match:
+            return set(self.slice(*match.groups()))
+
+        if any(c in selector for c in '*?['):
+            return set(fnmatch.filter(self.hosts, selector))
+
+        raise ValueError('Unknown host {!r}'.format(selector))
+
+    def match_role(self, role):
+        if role not in self.roledefs:
+            raise ValueError('Unknown role {!r}'.format(role))
+
+        hosts = self.roledefs[role]
+        if isinstance(hosts, dict):
+            hosts = hosts.get('hosts', [])
+        if callable(hosts):
+            hosts = hosts()
+
+        return set(host for host in hosts if host in self.positions)
+
+    def slice(self, start, end):
+        """
+        Get hosts by 1-based inclusive index range, where start or end may be empty.
+        """
+        start = int(start or 1)
+        end = int(end or len(self.hosts))
+        if not 1 <= start <= end <= len(self.hosts):
+            raise ValueError('Host index out of range {}-{}, {} hosts'.format(start, end, len(self.hosts)))
+        return self.hosts[start - 1:end]
@@ -1,52 +1,196 @@
 from collections import OrderedDict
+from contextlib import contextmanager
+from importlib import import_module
 from re import compile
+import sys
 
 import fabric.state
-from fabric.main import load_tasks_from_module, _task_names
+from fabric.main import load_tasks_from_module
+from fabric.task_utils import _Dict
 from fabric.utils import abort
 
+from .index import get_task_index
+from .parallel import copy_dict
+from .utils import invalidate, timed
+
 
 VAR_PATTERN = compile('\$\((.+?)\)')
 blueprints = OrderedDict()
+registered_packages = set()
 
+# Merged env values per role, see apply_role_profile()
+role_profiles = {}
 
-def load_blueprints(packages=None):
+
+class Unset(object):
     """
-    Load blueprints/tasks from fabric env
+    Marker of env keys missing before a role was applied. Survives copies of
+    env, i.e. by thread executor workers, to still match by identity.
     """
-    callables = OrderedDict()
-    executables = OrderedDict()
 
-    # Fallback on blueprints from env
-    packages = packages or fabric.state.env.get('blueprints') or []
+    def __copy__(self):
+        return self
 
-    for package in packages:
-        # Import blueprint module
-        package = str(package)
-        blueprint = package.rsplit('.', 1)[-1]
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return '<unset>'
+
+
+UNSET = Unset()
+
+# Env keys driving role switches, never restored on revert
+ROLE_KEYS = ('roles', 'states')
+
+
+class LazyBlueprint(_Dict):
+    """
+    Task mapping of a blueprint package, imported on first access.
+    Tasks are served as placeholders from the task index when possible, see refabric.index.
+    """
+
+    def __init__(self, package):
+        super(LazyBlueprint, self).__init__()
+        self.package = package
+        self.name = package.rsplit('.', 1)[-1]
+        self.filled = False
+        self.loaded = False
+
+        # Fabric drops the fabfile directory from sys.path after loading the fabfile
+        self.sys_path = list(sys.path)
+
+    @contextmanager
+    def import_path(self):
+        """
+        Temporarily restore sys.path as it was when blueprint got registered.
+        """
+        missing = [path for path in self.sys_path if path not in sys.path]
+        sys.path[:0] = missing
+        try:
+            yield
+        finally:
+            for path in missing:
+                sys.path.remove(path)
 
-        if blueprint not in blueprints:
-            imported = __import__(package)
+    def fill(self):
+        """
+        Fill mapping with indexed placeholder tasks, or load blueprint if not indexed.
+        """
+        if not self.filled:
+            with self.import_path():
+                tasks = get_task_index().get_tasks(self)
 
-            # Load tasks
-            _, new_style, classic, _ = load_tasks_from_module(imported)
+            if tasks is None:
+                self.load()
+            else:
+                dict.update(self, tasks)
+                if hasattr(tasks, 'default'):
+                    self.default = tasks.default
+                self.filled = True
+
+    def load(self):
+        """
+        Import blueprint package and load its tasks, once.
+
+        :return: Imported blueprint module
+        """
+        if not self.loaded:
+            with self.import_path(), timed('import blueprint {}'.format(self.package)):
+                self.module = import_module(self.package)
+
+            _, new_style, classic, default = load_tasks_from_module(self.module)
             tasks = new_style if fabric.state.env.new_style_tasks else classic
 
-            if tasks:
-                # Prefix top level imports with module/blueprint name
-                if not '.' in package:
-                    tasks = {blueprint: tasks}
+            # Replace any indexed placeholders with real tasks
+            dict.clear(self)
+            dict.update(self, tasks)
+            self.__dict__.pop('default', None)
+            if default is not None:
+                self.default = default
+
+            self.filled = self.loaded = True
+
+            with self.import_path():
+                index = get_task_index()
+                index.set_tasks(self, tasks, default)
+                index.save()
+
+        return self.module
+
+    def __getattr__(self, item):
+        if item == 'module' and not self.loaded:
+            self.load()
+            return self.module
+        if item == 'default' and not self.filled:
+            self.fill()
+            return getattr(self, item)
+        raise AttributeError(item)
+
+    def __getitem__(self, key):
+        self.fill()
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self.fill()
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        self.fill()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.fill()
+        return dict.__len__(self)
+
+    def __repr__(self):
+        if not self.filled:
+            return '<LazyBlueprint {}>'.format(self.package)
+        return dict.__repr__(self)
+
+
+def _filling(name):
+    method = getattr(dict, name)
+
+    def filling(self, *args, **kwargs):
+        self.fill()
+        return method(self, *args, **kwargs)
+
+    filling.__name__ = name
+    return filling
+
+for _name in ('get', 'has_key', 'keys', 'values', 'items', 'iterkeys', 'itervalues', 'iteritems', 'copy'):
+    setattr(LazyBlueprint, _name, _filling(_name))
 
-                callables.update(tasks)
-                executables[blueprint] = dict((name.split('.', 1)[-1], name) for name in _task_names(tasks))
 
-            executables[blueprint]['__module__'] = __import__(package, fromlist=[package])
+def load_blueprints(packages=None):
+    """
+    Register blueprints/tasks from fabric env.
+
+    Blueprint packages are not imported here, but on first use of their tasks,
+    i.e. when invoked or given to help/init, or when listed and not yet indexed.
+    Already registered packages are skipped.
+    """
+    # Fallback on blueprints from env
+    packages = packages or fabric.state.env.get('blueprints') or []
+
+    for package in packages:
+        package = str(package)
+        if package in registered_packages:
+            continue
 
-    # Update available tasks for fabric
-    fabric.state.commands.update(callables)
+        registered_packages.add(package)
+        blueprint = LazyBlueprint(package)
 
-    # Update available blueprints
-    blueprints.update(executables)
+        # Tasks are named relative to the top level package, i.e. foo.bar => bar.<task>
+        path = package.split('.')[1:] or [package]
+        commands = fabric.state.commands
+        for name in path[:-1]:
+            commands = commands.setdefault(name, _Dict())
+        commands[path[-1]] = blueprint
+
+        # Update available blueprints
+        blueprints.setdefault(blueprint.name, blueprint)
 
 
 def switch_env(name='default'):
@@ -64,28 +208,95 @@ def apply_role_definitions(role=None, force=False):
     """
     Merge or update role(s) definitions into env.
 
+    Only env values replaced by the role, or written while it is applied, are
+    remembered and restored on revert, so switching roles costs the same
+    regardless of env size, see remember_env().
+
     :param role: Name of role, if None given then only revert
     :param force: Skip reverting state before applying role
     """
+    env = fabric.state.env
+
     # Restore old env state
-    if not force and '_current' in fabric.state.env.states:
-        current_state = fabric.state.env.states.pop('_current')
-        fabric.state.env.clear()
-        fabric.state.env.update(current_state)
+    if not force and '_current' in env.states:
+        restore_env(env.states.pop('_current'))
 
     if role:
-        definitions = fabric.state.env.roledefs.get(role, {})
+        definitions = env.roledefs.get(role, {})
 
         # Ensure dict style role definitions
         if not isinstance(definitions, dict):
             abort('Roledefs must be dict style objects')
 
-        # Remember current env state
-        fabric.state.env.states['_current'] = fabric.state.env.copy()
+        # Remember current values of env keys about to be replaced
+        replaced = dict((key, env.get(key, UNSET)) for key in definitions)
+        env.states['_current'] = replaced
 
-        if fabric.state.env.merge_states:
-            fabric.state.env.merge(definitions)
-        else:
-            fabric.state.env.update(definitions)
+        apply_role_profile(role, definitions, replaced)
+
+        # Merge may update nested values in place
+        invalidate(env, definitions.keys())
 
     load_blueprints()
+
+
+def apply_role_profile(role, definitions, replaced):
+    """
+    Merge or update role definitions into env. Merged values are cached per role
+    and reused as is, as long as the role definitions and the env values they
+    were merged with are the same objects.
+
+    :param role: Name of role
+    :param definitions: Role definitions
+    :param replaced: Current env values of keys in definitions
+    """
+    env = fabric.state.env
+    cached = role_profiles.get(role)
+
+    if cached and cached[0] is definitions and cached[1] == env.merge_states \
+            and same_values(cached[2], replaced):
+        # Hand out copies, to not let tasks alter the cached profile
+        env.update(copy_dict(cached[3]))
+
+    else:
+        if env.merge_states:
+            env.merge(definitions)
+        else:
+            env.update(definitions)
+
+        profile = copy_dict(dict((key, env[key]) for key in definitions if key in env))
+        role_profiles[role] = (definitions, env.merge_states, dict(replaced), profile)
+
+
+def restore_env(replaced):
+    """
+    Restore env values replaced by a role.
+    """
+    env = fabric.state.env
+    env.update((key, value) for key, value in replaced.iteritems()
+               if value is not UNSET)
+    for key, value in replaced.iteritems():
+        if value is UNSET:
+            env.pop(key, None)
+
+
+def remember_env(keys=None):
+    """
+    Remember current values of env keys about to be written while a role is
+    applied, to be restored when the role is reverted.
+    Called by the patched env mutators, see refabric.utils._AttributeDict.
+
+    :param keys: Keys about to be written (Default: all keys, i.e. on clear)
+    """
+    env = fabric.state.env
+    replaced = (env.get('states') or {}).get('_current')
+    if replaced is None:
+        return
+
+    for key in env.keys() if keys is None else keys:
+        if key not in replaced and key not in ROLE_KEYS:
+            replaced[key] = env.get(key, UNSET)
+
+
+def same_values(a, b):
+    return a.viewkeys() == b.viewkeys() and all(a[key] is b[key] for key in a)
@@ -0,0 +1,217 @@
+import atexit
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from fabric.context_managers import settings
+from fabric.state import env
+
+from .utils import info, get_cache_dir
+
+__all__ = ['recorded', 'load_records', 'summarize', 'report']
+
+# Records are spooled to a file shared with forked parallel workers,
+# and reported by the main process on exit
+main_pid = os.getpid()
+spool_name = '{}-{}.jsonl'.format(main_pid, int(time.time()))
+spool_lock = threading.Lock()
+spooled = set()
+
+# Max length of recorded commands, keeping spooled lines short enough to append atomically
+MAX_COMMAND_LENGTH = 200
+
+PERCENTILES = (50, 90, 99)
+
+
+def is_enabled():
+    """
+    Check if stats are recorded, enabled by `env.stats` or `env.stats_json`,
+    i.e. `$ fab --set stats ...` or `$ fab --set stats_json=stats.json ...`.
+    """
+    return bool(env.get('stats') or env.get('stats_json'))
+
+
+def get_spool_path():
+    return os.path.join(get_cache_dir('stats'), spool_name)
+
+
+class Record(object):
+    """
+    Stats of a single remote call.
+    """
+
+    def __init__(self, op, command, use_sudo=False, user=None, sent=None):
+        self.op = op
+        self.command = command[:MAX_COMMAND_LENGTH]
+        self.host = env.host_string
+        self.user = (user or env.get('sudo_user', env.user)) if use_sudo else env.user
+        self.sudo = bool(use_sudo)
+        self.task = env.get('command')
+        self.return_code = None
+        self.error = None
+        self.sent = sent if sent is not None else len(command)
+        self.received = 0
+        self.start = time.time()
+        self.seconds = None
+
+    def result(self, result):
+        """
+        Record return code and received bytes of a run/sudo result.
+
+        :return: Given result
+        """
+        self.return_code = getattr(result, 'return_code', None)
+        self.received = len(result) + len(getattr(result, 'stderr', None) or '')
+        return result
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class NullRecord(object):
+    """
+    Stand-in record when stats are disabled.
+    """
+
+    def result(self, result):
+        return result
+
+
+@contextmanager
+def recorded(op, command='', use_sudo=False, user=None, sent=None):
+    """
+    Record wall time, host, user, return code and byte counts of a remote call within block.
+
+    :param op: Operation name, i.e. run, sudo or put
+    :param command: Command, or remote path
+    :param use_sudo: Run as sudo user
+    :param user: Sudo user
+    :param sent: Bytes sent (Default: length of command)
+    :return: Record, or a NullRecord if stats are disabled
+    """
+    if not is_enabled():
+        yield NullRecord()
+        return
+
+    record = Record(op, command, use_sudo=use_sudo, user=user, sent=sent)
+    try:
+        yield record
+    except BaseException as e:
+        record.error = e.__class__.__name__
+        raise
+    finally:
+        record.seconds = time.time() - record.start
+        line = json.dumps(record.to_dict()) + '\n'
+        with spool_lock:
+            path = get_spool_path()
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            spooled.add(path)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+
+def load_records():
+    """
+    Load records spooled by this run.
+
+    :return: List of record dicts
+    """
+    path = get_spool_path()
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, p):
+    """
+    Get nearest-rank percentile of sorted values.
+    """
+    index = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+def summarize(records, key):
+    """
+    Summarize round trips and latency of records grouped by key.
+
+    :param key: Record key to group by, i.e. host or task
+    :return: Dict of group to summary dict
+    """
+    groups = {}
+    for record in records:
+        groups.setdefault(record[key] or '', []).append(record)
+
+    summary = {}
+    for group, group_records in groups.iteritems():
+        seconds = sorted(r['seconds'] for r in group_records)
+        stats = {
+            'round_trips': len(group_records),
+            'failed': sum(1 for r in group_records if r['error'] or r['return_code']),
+            'sudo': sum(1 for r in group_records if r['sudo']),
+            'sent': sum(r['sent'] or 0 for r in group_records),
+            'received': sum(r['received'] or 0 for r in group_records),
+            'total': sum(seconds),
+            'max': seconds[-1],
+        }
+        for p in PERCENTILES:
+            stats['p{}'.format(p)] = percentile(seconds, p)
+        summary[group] = stats
+
+    return summary
+
+
+def print_summary(title, summary):
+    info('Stats per {}', title)
+    row = '{:<30} {:>6} {:>6} {:>9} {:>9} {:>9} {:>9} {:>9} {:>10} {:>10}'
+    print(row.format(title, 'calls', 'failed', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+                     'total s', 'sent', 'received'))
+    for group, stats in sorted(summary.items()):
+        columns = [group[:30], stats['round_trips'], stats['failed']]
+        columns.extend('{:.1f}'.format(stats[k] * 1000) for k in ('p50', 'p90', 'p99', 'max'))
+        columns.extend(('{:.2f}'.format(stats['total']), stats['sent'], stats['received']))
+        print(row.format(*columns))
+
+
+def report():
+    """
+    Print stats summary per host and task, and export them as JSON to `env.stats_json` if set.
+    Called on exit of the main process, removing the spool even if stats got disabled during the run.
+    """
+    if os.getpid() != main_pid or not (is_enabled() or spooled):
+        return
+
+    paths = spooled | set([get_spool_path()])
+    try:
+        if is_enabled():
+            report_records(load_records())
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def report_records(records):
+    if not records:
+        return
+
+    hosts = summarize(records, 'host')
+    tasks = summarize(records, 'task')
+
+    with settings(host_string=None):
+        if env.get('stats'):
+            print_summary('host', hosts)
+            print_summary('task', tasks)
+
+        if env.get('stats_json'):
+            with open(env.stats_json, 'w') as f:
+                json.dump({'hosts': hosts, 'tasks': tasks, 'records': records}, f, indent=2, sort_keys=True)
+            info('Stats exported to {}', env.stats_json)
+
+
+atexit.register(report)
@@ -1,10 +1,12 @@
 import fabric.state
 from fabric.context_managers import settings
-from fabric.operations import prompt
+from fabric.task_utils import crawl
 from fabric.tasks import requires_parallel
 from fabric.utils import abort
 
 from .colors import green
+from .operations import prompt
+from .selection import HostIndex
 from .state import blueprints
 from .utils import info
 
@@ -18,23 +20,29 @@ class Task(object):
                                                                                  arg_roles=arg_roles,
                                                                                  arg_exclude_hosts=arg_exclude_hosts,
                                                                                  env=env)
+        # Select hosts by expression, unless given explicitly for this execution
+        selection = fabric.state.env.get('select_hosts')
+        if selection and all_hosts and not arg_hosts:
+            try:
+                all_hosts = HostIndex(all_hosts, fabric.state.env.roledefs).select(selection)
+            except ValueError as e:
+                abort(str(e))
+
         # Prompt hosts if more than 1
-        if fabric.state.env.prompt_hosts and len(all_hosts) > 1 and not requires_parallel(self):
+        elif fabric.state.env.prompt_hosts and len(all_hosts) > 1 and not requires_parallel(self):
             print("0. All")
             for i, host in enumerate(all_hosts, start=1):
                 print("{i}. {host}".format(i=i, host=host))
 
+            index = HostIndex(all_hosts, fabric.state.env.roledefs)
+
             def validate_hosts(host_input):
-                check = lambda s: s.isdigit() and int(s) in range(len(all_hosts) + 1)
-                if not all(map(check, host_input.split(','))):
-                    raise Exception('Invalid host {!r}'.format(host_input))
-                else:
-                    return host_input
+                try:
+                    return index.select(host_input)
+                except ValueError as e:
+                    raise Exception(str(e))
 
-            host_choice = prompt(green('Select host(s)'), default='0', validate=validate_hosts)
-            indices = map(int, host_choice.split(','))
-            if len(indices) > 1 or indices[0] > 0:
-                all_hosts = [all_hosts[i-1] for i in indices if i > 0]
+            all_hosts = prompt(green('Select host(s)'), default='0', validate=validate_hosts)
 
         return all_hosts, effective_roles
 
@@ -49,10 +57,10 @@ def help_task(blueprint_name=None):
         abort('No blueprint provided, example: $ fab help:python')
 
     blueprint = blueprints.get(blueprint_name)
-    if not blueprint:
+    if blueprint is None:
         abort('Unknown blueprint "{}", using correct role?'.format(blueprint_name))
 
-    help(blueprint['__module__'])
+    help(blueprint.load())
 
 
 def init_task(blueprint_name=None):
@@ -65,10 +73,10 @@ def init_task(blueprint_name=None):
         abort('No blueprint provided, example: $ fab init:memcached')
 
     blueprint = blueprints.get(blueprint_name)
-    if not blueprint:
+    if blueprint is None:
         abort('Unknown blueprint "{}", using correct role?'.format(blueprint_name))
 
-    module = blueprint['__module__']
+    module = blueprint.load()
     if hasattr(module, 'blueprint'):
         module.blueprint.inherit_templates()
 
@@ -77,10 +85,35 @@ def init_task(blueprint_name=None):
         print module.__doc__
 
 
+def execute(task, *args, **kwargs):
+    """
+    Patched version of fabric.tasks.execute.
+    Runs hosts in rolling waves if configured by `env.waves` or the task, see refabric.decorators.rolling.
+    """
+    target = crawl(task, fabric.state.commands) if isinstance(task, basestring) else task
+
+    waves = getattr(target, 'waves', None) or fabric.state.env.get('waves')
+    if not waves or target is None:
+        return execute.original(task, *args, **kwargs)
+
+    from .parallel import execute_waves, get_task
+    return execute_waves(get_task(target), waves, *args, **kwargs)
+
+
 def _execute(task, host, my_env, args, kwargs, jobs, queue, multiprocessing):
     """
     Patched version of fabric.tasks._execute.
     Wraps original with `effective_roles` as `roles` in env to apply definitions.
+    Parallel hosts are run on threads instead of processes if `env.executor` is "threads".
+    Tasks are profiled if `env.profile` is set, see refabric.profiling.
     """
+    if multiprocessing is not None and fabric.state.env.get('executor') == 'threads':
+        from .parallel import Threads
+        multiprocessing = Threads
+
+    if fabric.state.env.get('profile'):
+        from .profiling import ProfiledTask
+        task = ProfiledTask(task, my_env['command'])
+
     with settings(roles=my_env['effective_roles']):
         return _execute.original(task, host, my_env, args, kwargs, jobs, queue, multiprocessing)
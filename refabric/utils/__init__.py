@@ -1,11 +1,15 @@
-import re
+import os
+import time
+from contextlib import contextmanager
+from fabric.state import env
 from fabric.utils import puts, warn
 
 from ..colors import grey, green, yellow
 
+from .resolver import SettingsView, get_resolver, invalidate
 from .socket import Socket
 
-__all__ = ['info', 'Socket']
+__all__ = ['info', 'get_cache_dir', 'Socket', 'SettingsView']
 
 
 def info(text, *args, **kwargs):
@@ -24,6 +28,52 @@ def info(text, *args, **kwargs):
         puts(text)
 
 
+@contextmanager
+def timed(label):
+    """
+    Measure time spent within block, printed if `env.import_times` is set,
+    i.e. `$ fab --set import_times ...`.
+
+    :param label: Label to print timing with
+    """
+    if not env.get('import_times'):
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        info(' {}: {} ms', label, '{:.1f}'.format((time.time() - start) * 1000))
+
+
+def get_cache_dir(*path):
+    """
+    Get local refabric cache directory, created if missing.
+    Located in a `.refabric` folder next to the fabfile unless `env.cache_root`
+    is set.
+
+    :param path: Optional sub directory path parts
+    :return: Absolute directory path
+    """
+    root = env.get('cache_root')
+    if not root:
+        fabfile = env.get('real_fabfile')
+        deploy_root = os.path.dirname(fabfile) if fabfile else os.getcwd()
+        root = os.path.join(deploy_root, '.refabric')
+
+    path = os.path.join(os.path.abspath(root), *path)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Could be created in between by another (parallel) process
+            if not os.path.isdir(path):
+                raise
+
+    return path
+
+
 class _AttributeDict(object):
     """
     Patched version (mixin) of fabric.utils._AttributeDict.
@@ -34,67 +84,65 @@ class _AttributeDict(object):
         """
         Catch set of key `roles` and apply related definitions into env.
         """
+        remember(self, [key])
         _AttributeDict.__setitem__.original(self, key, value)
+        invalidate(self, [key])
 
         if key == 'roles' and value:
             from refabric.state import apply_role_definitions
             apply_role_definitions(value[0])
 
+    @staticmethod
+    def __delitem__(self, key):
+        remember(self, [key])
+        _AttributeDict.__delitem__.original(self, key)
+        invalidate(self, [key])
+
+    @staticmethod
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        remember(self, other.keys())
+        _AttributeDict.update.original(self, other)
+        invalidate(self, other.keys())
+
+    @staticmethod
+    def pop(self, key, *default):
+        remember(self, [key])
+        value = _AttributeDict.pop.original(self, key, *default)
+        invalidate(self, [key])
+        return value
+
+    @staticmethod
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        remember(self, [key])
+        value = _AttributeDict.setdefault.original(self, key, default)
+        invalidate(self, [key])
+        return value
+
+    @staticmethod
+    def clear(self):
+        remember(self)
+        _AttributeDict.clear.original(self)
+        invalidate(self)
+
+
+def remember(dikt, keys=None):
+    """
+    Remember env values about to be written while a role is applied,
+    see refabric.state.remember_env().
+    """
+    if dikt is env:
+        from refabric.state import remember_env
+        remember_env(keys)
+
 
 def resolve(dikt, path=None, prefix=None, default=None):
     """
     Dict path lookup helper with deep dot notation, parent fallback and variable expansion.
+    Resolved values are memoized for fabric env, see resolver.Resolver.
+    Dicts and lists are returned as copies; after mutating nested env values in place,
+    call resolver.invalidate(env, [top level key]).
     """
-    try:
-        # Prefix path; a.b + c -> a.b.c
-        if prefix:
-            if path:
-                path = '.'.join((prefix, path))
-            else:
-                path = prefix
-
-        # Crawl path; a.b.c.edge -> env[a][b][c][edge]
-        nodes = path.split('.')
-
-        def crawl(container, key):
-            if isinstance(container, dict):
-                return container[key]
-            elif isinstance(container, list):
-                return container[int(key)]
-            else:
-                raise KeyError(key)
-
-        value = reduce(crawl, nodes, dikt)
-
-    except KeyError:
-        if len(nodes) == 1:
-            # Only non-existing edge left; return default
-            value = default
-        else:
-            # Try edge parent, a.b.c.edge -> a.b.edge
-            nodes = tuple(nodes)
-            path = '.'.join(nodes[:-2] + nodes[-1:])
-            value = resolve(dikt, path, default=default)
-
-    if isinstance(value, basestring):
-        # Value is string, expand internal variables if found; $(...)
-        if value:
-            resolve_var = lambda v, m: v.replace(m.group(0), resolve(dikt, m.group(1), default=default))
-            value = reduce(resolve_var, re.finditer('\$\((.+?)\)', value), value)
-
-        if value:
-            value = value.strip()
-
-    elif isinstance(value, dict):
-        # Value is dict, resolve item values to ensure variable expansion
-        for item_key, item_value in value.iteritems():
-            item_path = '.'.join((path, item_key))
-            value[item_key] = resolve(dikt, item_path)
-
-    elif isinstance(value, list):
-        # Value is list, resolve items to ensure variable expansion
-        for i, list_value in enumerate(value):
-            index_path = '.'.join((path, str(i)))
-            value[i] = resolve(dikt, index_path)
-
-    return value
+    return get_resolver(dikt).resolve(path, prefix=prefix, default=default)
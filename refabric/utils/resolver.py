@@ -0,0 +1,296 @@
+import copy
+import re
+import threading
+import weakref
+from collections import defaultdict
+
+import fabric.utils
+
+from ..profiling import phase
+
+__all__ = ['Resolver', 'SettingsView', 'get_resolver', 'invalidate']
+
+VAR_PATTERN = re.compile(r'\$\((.+?)\)')
+MISSING = object()
+
+# Resolvers of tracked dicts, by dict id
+resolvers = {}
+
+# Thread executor workers keep their own resolvers, see refabric.parallel
+local = threading.local()
+
+
+class Resolver(object):
+    """
+    Dict path lookup with deep dot notation, parent fallback and variable
+    expansion; a.b.c.edge -> dikt[a][b][c][edge] -> dikt[a][b][edge] etc.
+
+    Resolved values are memoized per path, together with the top level keys
+    they were resolved from, so a change of a top level key only drops
+    affected paths, see invalidate().
+
+    The source dict is never mutated, resolved dicts and lists are copies,
+    and handed out as copies of the memoized values, so callers may mutate
+    them. Nested values mutated in place in the source dict, i.e.
+    env.settings['key'] = ..., are not noticed; call invalidate() with the
+    top level key after doing so. Top level writes invalidate themselves,
+    see refabric.utils._AttributeDict.
+    """
+
+    def __init__(self, dikt):
+        self.dikt = dikt
+        self.cache = {}  # path -> (value, top level keys)
+        self.checked = {}  # path -> top level keys
+        self.dependents = defaultdict(set)  # top level key -> paths
+
+    def invalidate(self, keys=None):
+        """
+        Drop memoized paths resolved from given top level keys, or all paths.
+        """
+        if keys is None:
+            self.cache.clear()
+            self.checked.clear()
+            self.dependents.clear()
+        else:
+            for key in keys:
+                for path in self.dependents.pop(key, ()):
+                    self.cache.pop(path, None)
+                    self.checked.pop(path, None)
+
+    def resolve(self, path=None, prefix=None, default=None):
+        # Prefix path; a.b + c -> a.b.c
+        if prefix:
+            if path:
+                path = '.'.join((prefix, path))
+            else:
+                path = prefix
+
+        with phase('settings'):
+            value, _ = self.lookup(path)
+            if isinstance(value, (dict, list)):
+                # Keep memo intact from callers mutating the result
+                value = copy.deepcopy(value)
+        return default if value is MISSING else value
+
+    def lookup(self, path, resolving=()):
+        """
+        Resolve path, or get it from memo.
+
+        :param path: Dot notation path
+        :param resolving: Paths currently being resolved, to detect cycles
+        :return: tuple(value or MISSING, top level keys value depends on)
+        """
+        cached = self.cache.get(path)
+        if cached is not None:
+            return cached
+
+        if path in resolving:
+            raise ValueError('Circular setting reference: {}'.format(
+                ' -> '.join(resolving + (path,))))
+        resolving += (path,)
+
+        value, found_path, keys = self.locate(path)
+
+        if isinstance(value, basestring):
+            # Value is string, expand internal variables if found; $(...)
+            if '$(' in value:
+                def expand(match):
+                    var, var_keys = self.lookup(match.group(1), resolving)
+                    keys.update(var_keys)
+                    if var is MISSING:
+                        # Leave unknown variables as is
+                        return match.group(0)
+                    return var if isinstance(var, basestring) else str(var)
+
+                value = VAR_PATTERN.sub(expand, value)
+
+            if value:
+                value = value.strip()
+
+        elif isinstance(value, dict):
+            # Value is dict, resolve item values to ensure variable expansion
+            value = copy.copy(value)
+            for item_key in value.keys():
+                item_path = '{}.{}'.format(found_path, item_key)
+                value[item_key], item_keys = self.lookup(item_path, resolving)
+                keys.update(item_keys)
+
+        elif isinstance(value, list):
+            # Value is list, resolve items to ensure variable expansion
+            value = list(value)
+            for i in range(len(value)):
+                index_path = '{}.{}'.format(found_path, i)
+                value[i], index_keys = self.lookup(index_path, resolving)
+                keys.update(index_keys)
+
+        resolved = self.cache[path] = (value, frozenset(keys))
+        for key in keys:
+            self.dependents[key].add(path)
+
+        return resolved
+
+    def locate(self, path):
+        """
+        Crawl path, falling back on edge parent; a.b.c.edge -> a.b.edge
+
+        :return: tuple(raw value or MISSING, found path, top level keys)
+        """
+        keys = set()
+        nodes = path.split('.')
+        while True:
+            keys.add(nodes[0])
+            try:
+                value = reduce(crawl, nodes, self.dikt)
+                break
+            except (KeyError, IndexError):
+                if len(nodes) == 1:
+                    # Only non-existing edge left
+                    value = MISSING
+                    break
+                nodes = nodes[:-2] + nodes[-1:]
+
+        return value, '.'.join(nodes), keys
+
+    def check(self, path):
+        """
+        Build graph of variable references reachable from path, without
+        expanding any values, and raise ValueError on circular references.
+        Checked paths are memoized like resolved values.
+        """
+        if path in self.checked:
+            return
+
+        keys = set()
+        graph = {}  # path -> referenced paths
+
+        pending = [path]
+        while pending:
+            node = pending.pop()
+            if node in graph:
+                continue
+            value, found_path, node_keys = self.locate(node)
+            keys.update(node_keys)
+            if isinstance(value, basestring):
+                edges = VAR_PATTERN.findall(value)
+            elif isinstance(value, dict):
+                edges = ['{}.{}'.format(found_path, key) for key in value]
+            elif isinstance(value, list):
+                edges = ['{}.{}'.format(found_path, i)
+                         for i in range(len(value))]
+            else:
+                edges = []
+            graph[node] = edges
+            pending.extend(edges)
+
+        # Depth first search for a reference back to a path being visited
+        visited = set()
+        for node in graph:
+            stack = [(node, iter(graph[node]))]
+            visiting = [node]
+            while stack:
+                parent, edges = stack[-1]
+                edge = next(edges, None)
+                if edge is None:
+                    stack.pop()
+                    visiting.pop()
+                    visited.add(parent)
+                elif edge in visiting:
+                    cycle = visiting[visiting.index(edge):] + [edge]
+                    raise ValueError('Circular setting reference: {}'.format(
+                        ' -> '.join(cycle)))
+                elif edge not in visited:
+                    stack.append((edge, iter(graph[edge])))
+                    visiting.append(edge)
+
+        self.checked[path] = frozenset(keys)
+        for key in keys:
+            self.dependents[key].add(path)
+
+
+class SettingsView(object):
+    """
+    Lazy view of settings below a prefix, i.e. `settings.nginx`.
+
+    References between settings are checked for cycles up front, once per
+    state of the env keys involved, i.e. once per role. Values are expanded
+    on access, and memoized, by the resolver of given dict.
+    """
+
+    def __init__(self, dikt, prefix):
+        self.dikt = dikt
+        self.prefix = prefix
+
+    def get_resolver(self):
+        resolver = get_resolver(self.dikt)
+        resolver.check(self.prefix)
+        return resolver
+
+    def __call__(self, path=None, default=None):
+        return self.get_resolver().resolve(path, prefix=self.prefix,
+                                           default=default)
+
+    def fetch(self, *paths, **kwargs):
+        """
+        Resolve many settings in one pass.
+
+        :param paths: Setting paths, relative to prefix
+        :param default: Optional default value of missing settings
+        :return: Dict of path to value
+        """
+        resolver = self.get_resolver()
+        default = kwargs.get('default')
+        return dict((path, resolver.resolve(path, prefix=self.prefix,
+                                            default=default))
+                    for path in paths)
+
+
+def crawl(container, key):
+    if isinstance(container, dict):
+        return container[key]
+    elif isinstance(container, list):
+        return container[int(key)]
+    else:
+        raise KeyError(key)
+
+
+def is_tracked(dikt):
+    """
+    Check if dict reports its changes, i.e. fabric env when patched.
+    """
+    return isinstance(dikt, fabric.utils._AttributeDict) and \
+        hasattr(fabric.utils._AttributeDict.update, 'original')
+
+
+def get_registry():
+    """
+    Get resolvers of current thread.
+    """
+    return getattr(local, 'resolvers', resolvers)
+
+
+def get_resolver(dikt):
+    """
+    Get resolver for dict. Resolvers of tracked dicts are kept and reused,
+    others are only memoized for the lifetime of the returned resolver.
+    """
+    registry = get_registry()
+    entry = registry.get(id(dikt))
+    if entry and entry[0]() is dikt:
+        return entry[1]
+
+    resolver = Resolver(dikt)
+    if is_tracked(dikt):
+        key = id(dikt)
+        ref = weakref.ref(dikt, lambda _: registry.pop(key, None))
+        registry[key] = (ref, resolver)
+
+    return resolver
+
+
+def invalidate(dikt, keys=None):
+    """
+    Drop memoized paths of dict resolved from given top level keys, or all.
+    """
+    entry = get_registry().get(id(dikt))
+    if entry and entry[0]() is dikt:
+        entry[1].invalidate(keys)